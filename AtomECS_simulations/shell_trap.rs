@@ -7,16 +7,16 @@ use atomecs::ecs;
 use atomecs::ecs::AtomecsDispatcherBuilder;
 use atomecs::gravity::ApplyGravityOption;
 use atomecs::initiate::NewlyCreated;
-use atomecs::integrator::Timestep;
+use atomecs::integrator::{Step, Timestep};
 use atomecs::magnetic::quadrupole::QuadrupoleField3D;
-use atomecs::output::file;
-use atomecs::output::file::Text;
 use atomecs::ramp::{Ramp};
 use nalgebra::Vector3;
 use rand_distr::{Distribution, Normal};
 use specs::prelude::*;
 use std::time::Instant;
-use std::fs::read_to_string;
+use std::fs::{create_dir_all, read_to_string, File};
+use std::io::{BufWriter, Write};
+use std::marker::PhantomData;
 
 
 extern crate rb173;
@@ -51,12 +51,171 @@ pub struct SimulationParameters {
     pub timestep: f64,
     pub num_steps: i32,
     pub gravity: bool,
+    /// Output files to write, see `OutputPlan`. Defaults to velocities every 100 steps and positions every 10 steps.
+    #[serde(default = "default_output_plan")]
+    pub output: Vec<OutputPlan>,
+}
+
+/// One output file of the simulation, written in the AtomECS `Text` format.
+#[derive(Deserialize)]
+pub struct OutputPlan {
+    /// Component to write, "position" or "velocity"
+    pub component: String,
+    /// File name, relative to the output directory
+    pub file: String,
+    /// First step written
+    #[serde(default)]
+    pub start: u64,
+    /// Last step written, or every step to the end of the simulation if absent
+    #[serde(default)]
+    pub end: Option<u64>,
+    /// Number of steps between frames
+    pub interval: u64,
+    /// Only atoms whose entity id is a multiple of atom_stride are written
+    #[serde(default = "default_atom_stride")]
+    pub atom_stride: u32,
+}
+
+fn default_atom_stride() -> u32 {
+    1
+}
+
+fn default_output_plan() -> Vec<OutputPlan> {
+    vec![
+        OutputPlan {
+            component: "velocity".to_string(),
+            file: "vel.txt".to_string(),
+            start: 0,
+            end: None,
+            interval: 100,
+            atom_stride: 1,
+        },
+        OutputPlan {
+            component: "position".to_string(),
+            file: "pos.txt".to_string(),
+            start: 0,
+            end: None,
+            interval: 10,
+            atom_stride: 1,
+        },
+    ]
+}
+
+/// Components which can be written by a `PlannedOutputSystem`.
+pub trait OutputVector {
+    fn vector(&self) -> Vector3<f64>;
+}
+
+impl OutputVector for Position {
+    fn vector(&self) -> Vector3<f64> {
+        self.pos
+    }
+}
+
+impl OutputVector for Velocity {
+    fn vector(&self) -> Vector3<f64> {
+        self.vel
+    }
+}
+
+/// Writes a component of the atoms to file in the AtomECS `Text` format, for the steps and atoms
+/// selected by an `OutputPlan`.
+pub struct PlannedOutputSystem<C> {
+    start: u64,
+    end: Option<u64>,
+    interval: u64,
+    atom_stride: u32,
+    writer: BufWriter<File>,
+    marker: PhantomData<C>,
+}
+
+impl<C> PlannedOutputSystem<C> {
+    fn new(plan: &OutputPlan, output_dir: &str) -> Self {
+        if plan.interval == 0 {
+            panic!("Output plan for '{}' has an interval of 0, it must be at least 1.", plan.file);
+        }
+        if plan.atom_stride == 0 {
+            panic!("Output plan for '{}' has an atom_stride of 0, it must be at least 1.", plan.file);
+        }
+        let file_name = format!("{}/{}", output_dir, plan.file);
+        let file = File::create(&file_name).expect("Could not create output file.");
+        PlannedOutputSystem {
+            start: plan.start,
+            end: plan.end,
+            interval: plan.interval,
+            atom_stride: plan.atom_stride,
+            writer: BufWriter::new(file),
+            marker: PhantomData,
+        }
+    }
+}
+
+impl<'a, C> System<'a> for PlannedOutputSystem<C>
+where
+    C: Component + OutputVector + Send + Sync,
+{
+    type SystemData = (Entities<'a>, ReadStorage<'a, C>, ReadStorage<'a, Atom>, ReadExpect<'a, Step>);
+
+    fn run(&mut self, (entities, data, atoms, step): Self::SystemData) {
+        let n = step.n;
+        if n < self.start || self.end.map_or(false, |end| n > end) || (n - self.start) % self.interval != 0 {
+            return;
+        }
+
+        let atom_stride = self.atom_stride;
+        let records: Vec<(Entity, Vector3<f64>)> = (&entities, &data, &atoms)
+            .join()
+            .filter(|(atom, _, _)| atom.id() % atom_stride == 0)
+            .map(|(atom, value, _)| (atom, value.vector()))
+            .collect();
+
+        writeln!(self.writer, "step-{:?}, {:?}", n, records.len()).expect("Could not write output.");
+        for (atom, value) in records {
+            writeln!(
+                self.writer,
+                "{:?},{:?}: ({:?},{:?},{:?})",
+                atom.gen().id(),
+                atom.id(),
+                value[0],
+                value[1],
+                value[2]
+            )
+            .expect("Could not write output.");
+        }
+    }
+}
+
+/// Contents of `input.json`: either a single set of parameters, or a batch of configurations which
+/// are simulated one after the other in the same process.
+#[derive(Deserialize)]
+#[serde(untagged)]
+pub enum SimulationInput {
+    Batch { configurations: Vec<SimulationParameters> },
+    Single(SimulationParameters),
 }
 
 fn main() {
     let now = Instant::now();
-    let parameters = load_parameters();
 
+    // A single configuration writes to shell_trap_output/, configuration i of a batch to shell_trap_output/config_i/.
+    match load_parameters() {
+        SimulationInput::Single(parameters) => {
+            run_configuration(&parameters, "shell_trap_output");
+        }
+        SimulationInput::Batch { configurations } => {
+            for (i, parameters) in configurations.iter().enumerate() {
+                let output_dir = format!("shell_trap_output/config_{}", i);
+                create_dir_all(&output_dir).expect("Could not create the configuration output directory.");
+                run_configuration(parameters, &output_dir);
+            }
+        }
+    }
+
+    println!("Simulation completed in {} ms.", now.elapsed().as_millis());
+}
+
+/// Simulate one configuration, writing its output into `output_dir`.
+fn run_configuration(parameters: &SimulationParameters, output_dir: &str) {
     // Create the simulation world and builder for the ECS dispatcher.
     let mut world = World::new();
     ecs::register_components(&mut world);
@@ -74,18 +233,14 @@ fn main() {
     atomecs_builder.add_frame_end_systems();
     let mut builder = atomecs_builder.builder;
 
-    // Configure simulation output.
-    builder = builder.with(
-      file::new::<Velocity, Text>("shell_trap_output/vel.txt".to_string(), 100),
-      "",
-      &[],
-    );
-
-    builder = builder.with(
-      file::new::<Position, Text>("shell_trap_output/pos.txt".to_string(), 10),
-      "",
-      &[],
-    );
+    // Configure simulation output, as requested by the output plan in the input file.
+    for plan in parameters.output.iter() {
+        builder = match plan.component.as_str() {
+            "position" => builder.with(PlannedOutputSystem::<Position>::new(plan, output_dir), "", &[]),
+            "velocity" => builder.with(PlannedOutputSystem::<Velocity>::new(plan, output_dir), "", &[]),
+            component => panic!("Unknown output component '{}'.", component),
+        };
+    }
 
     let mut dispatcher = builder.build();
     dispatcher.setup(&mut world);
@@ -144,15 +299,13 @@ fn main() {
         dispatcher.dispatch(&mut world);
         world.maintain();
     }
-
-    println!("Simulation completed in {} ms.", now.elapsed().as_millis());
 }
 
 /// Load simulation parameters from a json-formatted file, named `input.json`.
-fn load_parameters() -> SimulationParameters {
+fn load_parameters() -> SimulationInput {
     let json_str = read_to_string("input.json").expect(
         "Could not open json-formatted file 'input.json', required to configure the simulation.",
     );
-    let parameters: SimulationParameters = serde_json::from_str(&json_str).unwrap();
+    let parameters: SimulationInput = serde_json::from_str(&json_str).unwrap();
     return parameters;
 }
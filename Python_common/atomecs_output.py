@@ -0,0 +1,249 @@
+import os
+import re
+import numpy as np
+from itertools import islice
+
+from compressed_output import is_compressed, open_output, resolve_output
+
+# Readers for the AtomECS `Text` file output, which is written as a sequence of frames:
+#
+#   step-N, count
+#   gen,id: (x,y,z)
+#   ... (count atom records)
+#
+# Each frame is parsed in bulk rather than line by line, by replacing the record separators
+# with whitespace and converting the whole block with a single numpy call.
+#
+# Every reader also accepts a compressed output file (see compressed_output) under its uncompressed
+# name. Compressed files are streamed, so step selections on them are made while reading through the
+# file rather than by seeking through the step index.
+
+# Number of values in one atom record once the separators are stripped (gen, id, x, y, z)
+values_per_record = 5
+
+# Translation table mapping the separators in an atom record onto whitespace
+record_separators = bytes.maketrans(b',:()', b'    ')
+
+# Pattern matching a frame header, used to index a file without parsing its records. Atom records
+# never contain `step-`, so the literal prefix lets the regex engine skip straight between headers.
+header_pattern = re.compile(rb'step-(\d+), (\d+)')
+
+# Step indexes already loaded by this process, keyed by file path
+step_indexes = {}
+
+# Function to parse a `step-N, count` frame header into the step number and atom count
+def parse_header(line):
+  step, count = line[len(b'step-'):].split(b',')
+  return int(step), int(count)
+
+# Function to parse the raw atom records of a frame into an array of atom ids and an (atoms, 3) value array
+def parse_records(records, dtype=np.float64):
+  values = np.fromstring(records.translate(record_separators), sep=' ')
+  if values.size % values_per_record != 0:
+    raise ValueError('Malformed atom records in AtomECS output frame')
+  values = values.reshape(-1, values_per_record)
+  return values[:, 1].astype(np.int64), values[:, 2:].astype(dtype, copy=False)
+
+# Generator over the frames of an open (binary mode) output file, yielding the step number, atom count and raw records
+def iter_frames(f):
+  for line in f:
+    if not line.startswith(b'step-'):
+      continue
+    step, count = parse_header(line)
+    yield step, count, b''.join(islice(f, count))
+
+# Function to scatter the values of one frame into a row of the output array, matched by atom id
+def fill_frame(row, atom_ids, frame_ids, frame_values):
+  # Atoms missing from the frame (e.g. lost from the simulation volume) are left as NaN
+  row[:] = np.nan
+  order = np.argsort(frame_ids, kind='stable')
+  sorted_ids = frame_ids[order]
+  idx = np.searchsorted(sorted_ids, atom_ids)
+  idx[idx == len(sorted_ids)] = 0
+  found = sorted_ids[idx] == atom_ids if len(sorted_ids) > 0 else np.zeros(len(atom_ids), dtype=bool)
+  row[found] = frame_values[order[idx[found]]]
+
+# Function to scan an output file once for the step number, byte offset and atom count of every frame
+def build_step_index(filename, chunk_size=1 << 24):
+  steps = []
+  offsets = []
+  counts = []
+  with open_output(filename) as f:
+    position = 0
+    carry = b''
+    while True:
+      chunk = f.read(chunk_size)
+      if not chunk:
+        break
+
+      # Only search complete lines, carrying the partial last line over to the next chunk
+      data = carry + chunk
+      start = position - len(carry)
+      end = data.rfind(b'\n') + 1
+      for match in header_pattern.finditer(data, 0, end):
+        steps.append(int(match.group(1)))
+        offsets.append(start + match.start())
+        counts.append(int(match.group(2)))
+
+      carry = data[end:]
+      position += len(chunk)
+
+  return np.array(steps, dtype=np.int64), np.array(offsets, dtype=np.int64), np.array(counts, dtype=np.int64)
+
+# Function to return the step index of an output file, reusing the `.idx.npz` sidecar while the file is unchanged
+def load_step_index(filename):
+  filename = resolve_output(filename)
+  stat = os.stat(filename)
+  key = os.path.abspath(filename)
+  if key in step_indexes and step_indexes[key][0] == (stat.st_size, stat.st_mtime_ns):
+    return step_indexes[key][1]
+
+  index_filename = str(filename) + '.idx.npz'
+  index = None
+  if os.path.exists(index_filename):
+    with np.load(index_filename) as sidecar:
+      if sidecar['size'] == stat.st_size and sidecar['mtime_ns'] == stat.st_mtime_ns:
+        index = (sidecar['steps'], sidecar['offsets'], sidecar['counts'])
+
+  if index is None:
+    index = build_step_index(filename)
+    try:
+      with open(index_filename, 'wb') as f:
+        np.savez(f, steps=index[0], offsets=index[1], counts=index[2], size=stat.st_size, mtime_ns=stat.st_mtime_ns)
+    except OSError:
+      # The index is only an optimisation, so a read-only output directory is not an error
+      pass
+
+  step_indexes[key] = ((stat.st_size, stat.st_mtime_ns), index)
+  return index
+
+# Function to read the raw records of the frame at position i of a step index from an open file
+def read_indexed_frame(f, index, i):
+  steps, offsets, counts = index
+  f.seek(offsets[i])
+  if i + 1 < len(offsets):
+    frame = f.read(offsets[i + 1] - offsets[i])
+  else:
+    frame = f.read()
+  return frame[frame.index(b'\n') + 1:]
+
+# Function to read an AtomECS Text output file into a (steps, atoms, 3) array
+#
+# atoms: optional array of atom ids to extract, defaults to every atom present in the first selected frame
+# steps: optional container of step numbers to extract, e.g. range(7500, 10001, 100)
+# dtype: float type of the returned values, float32 halves the memory for large runs
+#
+# Returns the step numbers, the atom ids and the values array. Atoms which are not present
+# in a frame have NaN values for that step.
+def read_output(filename, atoms=None, steps=None, dtype=np.float64):
+  filename = resolve_output(filename)
+  atom_ids = None if atoms is None else np.sort(np.asarray(atoms, dtype=np.int64))
+  if steps is not None and not is_compressed(filename):
+    return read_indexed_output(filename, atom_ids, steps, dtype)
+
+  step_numbers = []
+  values = None
+  with open_output(filename) as f:
+    for step, count, records in iter_frames(f):
+      if steps is not None and step not in steps:
+        continue
+      frame_ids, frame_values = parse_records(records, dtype)
+      if atom_ids is None:
+        atom_ids = np.sort(frame_ids)
+
+      # Grow the preallocated output geometrically, as the number of frames is not known up front
+      if values is None:
+        values = np.empty((16, len(atom_ids), 3), dtype=dtype)
+      elif len(step_numbers) == len(values):
+        grown = np.empty((2 * len(values), len(atom_ids), 3), dtype=dtype)
+        grown[:len(values)] = values
+        values = grown
+
+      fill_frame(values[len(step_numbers)], atom_ids, frame_ids, frame_values)
+      step_numbers.append(step)
+
+  if values is None:
+    values = np.empty((0, 0 if atom_ids is None else len(atom_ids), 3), dtype=dtype)
+    atom_ids = np.empty(0, dtype=np.int64) if atom_ids is None else atom_ids
+
+  return np.array(step_numbers, dtype=np.int64), atom_ids, values[:len(step_numbers)]
+
+# Function to read a selection of steps, seeking to each selected frame through the step index
+def read_indexed_output(filename, atom_ids, steps, dtype):
+  index = load_step_index(filename)
+  selected = [i for i, step in enumerate(index[0]) if step in steps]
+
+  values = None
+  with open(filename, 'rb') as f:
+    for row, i in enumerate(selected):
+      frame_ids, frame_values = parse_records(read_indexed_frame(f, index, i), dtype)
+      if atom_ids is None:
+        atom_ids = np.sort(frame_ids)
+      if values is None:
+        values = np.empty((len(selected), len(atom_ids), 3), dtype=dtype)
+      fill_frame(values[row], atom_ids, frame_ids, frame_values)
+
+  if values is None:
+    atom_ids = np.empty(0, dtype=np.int64) if atom_ids is None else atom_ids
+    values = np.empty((0, len(atom_ids), 3), dtype=dtype)
+
+  return index[0][selected], atom_ids, values
+
+# Function to return the step number and atom count of the last frame header, reading backwards from the end of the file
+def read_last_header(filename, chunk_size=1 << 16):
+  filename = resolve_output(filename)
+  if is_compressed(filename):
+    # A compressed file can't be read backwards, so its last header comes from the step index
+    steps, offsets, counts = load_step_index(filename)
+    if len(steps) == 0:
+      raise ValueError('No frame header found in ' + str(filename))
+    return int(steps[-1]), int(counts[-1])
+
+  with open(filename, 'rb') as f:
+    position = f.seek(0, os.SEEK_END)
+    tail = b''
+    while position > 0:
+      read_size = min(chunk_size, position)
+      position -= read_size
+      f.seek(position)
+      tail = f.read(read_size) + tail
+
+      # Everything after a complete `step-` prefix is in the tail, so the last match is a whole header
+      matches = list(header_pattern.finditer(tail))
+      if len(matches) > 0:
+        return int(matches[-1].group(1)), int(matches[-1].group(2))
+
+  raise ValueError('No frame header found in ' + str(filename))
+
+# Function to return the number of atoms written at a given step
+#
+# The final step is found by seeking backwards from the end of the file, so it costs a single small
+# read. Any other step is looked up in the step index.
+def read_atom_count(filename, step):
+  last_step, last_count = read_last_header(filename)
+  if last_step == step:
+    return last_count
+
+  steps, offsets, counts = load_step_index(filename)
+  i = np.searchsorted(steps, step)
+  if i == len(steps) or steps[i] != step:
+    raise ValueError('Step ' + str(step) + ' not found in ' + str(filename))
+  return int(counts[i])
+
+# Function to read the atom ids and (atoms, 3) values of a single step, seeking straight to it through the step index
+def read_step(filename, step, dtype=np.float64):
+  filename = resolve_output(filename)
+  if is_compressed(filename):
+    with open_output(filename) as f:
+      for frame_step, count, records in iter_frames(f):
+        if frame_step == step:
+          return parse_records(records, dtype)
+    raise ValueError('Step ' + str(step) + ' not found in ' + str(filename))
+
+  index = load_step_index(filename)
+  i = np.searchsorted(index[0], step)
+  if i == len(index[0]) or index[0][i] != step:
+    raise ValueError('Step ' + str(step) + ' not found in ' + str(filename))
+
+  with open(filename, 'rb') as f:
+    return parse_records(read_indexed_frame(f, index, i), dtype)
@@ -0,0 +1,146 @@
+import hashlib
+import os
+import warnings
+import numpy as np
+
+from results_store import convert_csv, load_capture_fractions
+
+# Aggregate statistics of a capture fraction sweep, shared by the capture fraction plots.
+#
+# The statistics of every (offset, detuning) cell are computed in one pass over the (offsets, detunings,
+# repeats) grid of a results store: mean, stdev and percent stdev of the repeats, bootstrap confidence
+# bands for each, and polynomial trendlines over detuning for every offset. They're saved next to the
+# store as
+#
+#   <store>.stats.npz
+#
+# keyed by the sha256 of the store and the settings used, so plots load them without touching the
+# repeats again, and they're recomputed whenever the store gains results.
+#
+# The store holds detuning magnitudes, while the plots use the (negative) red detuning, so trendlines
+# are polynomials in the red detuning, -detuning, and are evaluated at the detunings as plotted.
+
+statistic_names = ('mean', 'stdev', 'percent stdev')
+
+# Version of the cached statistics, part of the cache key so caches from older versions are recomputed
+stats_version = 2
+
+# Function to return the sha256 of a file
+def file_hash(filename, chunk_size=1 << 20):
+  sha256 = hashlib.sha256()
+  with open(filename, 'rb') as f:
+    for chunk in iter(lambda: f.read(chunk_size), b''):
+      sha256.update(chunk)
+  return sha256.hexdigest()
+
+# Function to return the path of the statistics cache of a results store
+def stats_cache_path(store_filename):
+  return str(store_filename) + '.stats.npz'
+
+# Function to return the mean, stdev and percent stdev over the last axis of a NaN padded array of repeats
+#
+# The percent stdev is 0 where the mean is 0, as for a cell where no atoms were ever captured.
+def repeat_statistics(capture_fractions):
+  # Cells without any repeats are left NaN, without warning about the empty slices
+  with warnings.catch_warnings(), np.errstate(invalid='ignore', divide='ignore'):
+    warnings.simplefilter('ignore', RuntimeWarning)
+    means = np.nanmean(capture_fractions, axis=-1)
+    stdevs = np.nanstd(capture_fractions, axis=-1)
+    percent_stdevs = np.where(means != 0, stdevs / means * 100, 0.0)
+  return means, stdevs, percent_stdevs
+
+# Function to return bootstrap confidence bands of the mean, stdev and percent stdev of every cell
+#
+# Each resample draws as many repeats (with replacement) as the cell has, from that cell's own repeats.
+# Resamples are drawn in batches of batch_size, to bound the memory used for large grids.
+# Returns lower and upper bounds, each of shape (3, *cells) in the order of statistic_names.
+def bootstrap_bands(capture_fractions, num_resamples=1000, confidence=0.95, rng=None, batch_size=50):
+  rng = np.random.default_rng(rng)
+  # Sorting moves the NaN padding to the end, so the repeats of a cell with n of them are its first n
+  repeats = np.sort(capture_fractions, axis=-1)
+  counts = np.sum(~np.isnan(repeats), axis=-1)
+  num_repeats = repeats.shape[-1]
+
+  resampled = []
+  for start in range(0, num_resamples, batch_size):
+    size = min(batch_size, num_resamples - start)
+    draws = rng.random((size,) + repeats.shape)
+    indices = np.minimum((draws * counts[..., None]).astype(np.int64), np.maximum(counts[..., None] - 1, 0))
+    samples = np.take_along_axis(np.broadcast_to(repeats, draws.shape), indices, axis=-1)
+    # Cells with fewer repeats than the grid are padded again, so each resample has the cell's own size
+    samples[..., np.arange(num_repeats) >= counts[..., None]] = np.nan
+    resampled.append(np.stack(repeat_statistics(samples), axis=1))
+  resampled = np.concatenate(resampled, axis=0)
+
+  tail = 50 * (1 - confidence)
+  with warnings.catch_warnings():
+    warnings.simplefilter('ignore', RuntimeWarning)
+    lower, upper = np.nanpercentile(resampled, [tail, 100 - tail], axis=0)
+  return lower, upper
+
+# Function to fit a polynomial trendline over detuning to every row of values, with a single least squares solve
+#
+# values: array of shape (rows, detunings)
+# Returns polynomial coefficients of shape (degree + 1, rows), highest power first as for np.polyval.
+# Rows holding NaNs, from cells without any repeats, are given NaN coefficients.
+def fit_trendlines(detunings, values, degree=11):
+  values = np.asarray(values, dtype=np.float64)
+  coefficients = np.full((degree + 1, values.shape[0]), np.nan)
+  complete = ~np.any(np.isnan(values), axis=1)
+  if np.any(complete):
+    coefficients[:, complete] = np.polyfit(detunings, values[complete].T, degree)
+  return coefficients
+
+# Function to evaluate trendlines at the given (negative, red) detunings, returning an array of shape (rows, detunings)
+def evaluate_trendlines(coefficients, detunings):
+  return np.polyval(coefficients, np.asarray(detunings, dtype=np.float64)[:, None]).T
+
+# Function to compute every statistic of a results store
+def compute_statistics(store_filename, number_of_steps=None, num_resamples=1000, confidence=0.95, degree=11, seed=0):
+  offset_deltas, detunings, capture_fractions = load_capture_fractions(store_filename, number_of_steps)
+  values = np.stack(repeat_statistics(capture_fractions))
+  lower, upper = bootstrap_bands(capture_fractions, num_resamples, confidence, rng=seed)
+  trendlines = np.stack([fit_trendlines(-detunings, statistic, degree) for statistic in values])
+
+  return {
+    'offset_deltas': offset_deltas,
+    'detunings': detunings,
+    'num_repeats': np.sum(~np.isnan(capture_fractions), axis=-1),
+    'values': values,
+    'lower': lower,
+    'upper': upper,
+    'trendlines': trendlines,
+  }
+
+# Function to load the statistics of a results store through the cache, computing them first if needed
+#
+# csv_filename: optional old style sweep csv, converted into the store if the store doesn't exist yet
+#
+# Returns a dict of
+#   offset_deltas, detunings: the sorted grid axes, with the detunings as stored (magnitudes)
+#   num_repeats: (offsets, detunings) number of repeats behind each cell
+#   values, lower, upper: (3, offsets, detunings) statistics and bootstrap bounds, in the order of statistic_names
+#   trendlines: (3, degree + 1, offsets) trendline coefficients for each statistic, as polynomials in
+#     the red detuning -detunings, see evaluate_trendlines
+def load_statistics(store_filename, csv_filename=None, number_of_steps=None, num_resamples=1000, confidence=0.95, degree=11, seed=0):
+  if csv_filename is not None and not os.path.exists(store_filename):
+    convert_csv(csv_filename, store_filename)
+
+  key = '{}:{}:{}:{}:{}:{}:{}'.format(stats_version, file_hash(store_filename), number_of_steps, num_resamples, confidence, degree, seed)
+  cache_path = stats_cache_path(store_filename)
+  if os.path.exists(cache_path):
+    with np.load(cache_path) as cache:
+      if str(cache['key']) == key:
+        return {name: cache[name] for name in cache.files if name != 'key'}
+
+  statistics = compute_statistics(store_filename, number_of_steps, num_resamples, confidence, degree, seed)
+  # Write to a temporary name and move into place, so an interrupted save is never loaded
+  tmp_path = cache_path + '.tmp'
+  with open(tmp_path, 'wb') as f:
+    np.savez(f, key=key, **statistics)
+  os.replace(tmp_path, cache_path)
+  return statistics
+
+# Function to return the index of a statistic in the arrays returned by load_statistics
+def statistic_index(name):
+  return statistic_names.index(name)
@@ -0,0 +1,199 @@
+import fnmatch
+import gzip
+import io
+import lzma
+import os
+import queue
+import shutil
+import sys
+import threading
+
+try:
+  import zstandard
+except ImportError:
+  zstandard = None
+
+# Transparent reading of compressed AtomECS output, and compaction of finished run directories.
+#
+# A finished run's output files can be compressed in place, e.g. pos.txt to pos.txt.zst, with
+# compact_run. The readers in atomecs_output, output_cache, trajectory_cache and thermalisation take
+# the uncompressed name and resolve it to whichever of pos.txt, pos.txt.zst, pos.txt.gz or pos.txt.xz
+# exists, decompressing as they stream through the file. Decompression runs on a read-ahead thread,
+# which the codecs allow to run alongside parsing as they release the GIL, so it overlaps the parse
+# rather than adding to it.
+#
+# zstd needs the optional zstandard package, gzip and xz only need the standard library.
+
+# Codec of each compressed file suffix, in the order they're looked for
+compression_suffixes = {'.zst': 'zstd', '.gz': 'gzip', '.xz': 'xz'}
+
+# Function to return the codec of a file from its suffix, or None if it isn't compressed
+def compression(filename):
+  for suffix, codec in compression_suffixes.items():
+    if str(filename).endswith(suffix):
+      return codec
+  return None
+
+# Function to return whether a file is compressed
+def is_compressed(filename):
+  return compression(filename) is not None
+
+# Function to return the path of an output file as it exists on disk, which may be a compressed version of it
+#
+# Names which don't exist in any form are returned unchanged, so opening them raises the usual error.
+def resolve_output(filename):
+  filename = str(filename)
+  if os.path.exists(filename) or is_compressed(filename):
+    return filename
+  for suffix in compression_suffixes:
+    if os.path.exists(filename + suffix):
+      return filename + suffix
+  return filename
+
+# Function to raise a clear error if zstd is needed but the zstandard package isn't installed
+def require_zstandard(filename):
+  if zstandard is None:
+    raise ImportError('Reading or writing ' + str(filename) + ' needs the zstandard package (pip install zstandard)')
+
+# Raw stream decompressing another stream on a background thread, chunk_size bytes at a time and up to
+# prefetch chunks ahead of the reader
+class ReadAheadStream(io.RawIOBase):
+  def __init__(self, stream, chunk_size=1 << 22, prefetch=4):
+    self.stream = stream
+    self.chunk_size = chunk_size
+    self.chunks = queue.Queue(maxsize=prefetch)
+    self.current = memoryview(b'')
+    self.finished = False
+    self.stopped = threading.Event()
+    self.thread = threading.Thread(target=self.decompress, daemon=True)
+    self.thread.start()
+
+  def decompress(self):
+    try:
+      while not self.stopped.is_set():
+        chunk = self.stream.read(self.chunk_size)
+        self.put(chunk)
+        if not chunk:
+          return
+    except Exception as e:
+      # Decompression errors are raised in the reading thread
+      self.put(e)
+
+  def put(self, item):
+    while not self.stopped.is_set():
+      try:
+        self.chunks.put(item, timeout=0.1)
+        return
+      except queue.Full:
+        pass
+
+  def readable(self):
+    return True
+
+  def readinto(self, buffer):
+    while len(self.current) == 0:
+      if self.finished:
+        return 0
+      chunk = self.chunks.get()
+      if isinstance(chunk, Exception):
+        self.finished = True
+        raise chunk
+      if not chunk:
+        self.finished = True
+        return 0
+      self.current = memoryview(chunk)
+
+    size = min(len(buffer), len(self.current))
+    buffer[:size] = self.current[:size]
+    self.current = self.current[size:]
+    return size
+
+  def close(self):
+    if not self.closed:
+      self.stopped.set()
+      self.thread.join()
+      self.stream.close()
+    super().close()
+
+# Function to open an output file, or the compressed version of it, as a binary file streaming its uncompressed contents
+#
+# Compressed files are read sequentially (the returned file can't seek), plain files are opened as usual.
+def open_output(filename):
+  filename = resolve_output(filename)
+  codec = compression(filename)
+  if codec is None:
+    return open(filename, 'rb')
+
+  if codec == 'gzip':
+    stream = gzip.open(filename, 'rb')
+  elif codec == 'xz':
+    stream = lzma.open(filename, 'rb')
+  else:
+    require_zstandard(filename)
+    stream = zstandard.ZstdDecompressor().stream_reader(open(filename, 'rb'), closefd=True)
+  return io.BufferedReader(ReadAheadStream(stream), buffer_size=1 << 20)
+
+# Function to open a file for writing through a compressor
+def open_compressed(filename, codec, level=None):
+  if codec == 'gzip':
+    return gzip.open(filename, 'wb', compresslevel=6 if level is None else level)
+  if codec == 'xz':
+    return lzma.open(filename, 'wb', preset=6 if level is None else level)
+  require_zstandard(filename)
+  # zstd compresses on every core
+  compressor = zstandard.ZstdCompressor(level=3 if level is None else level, threads=-1)
+  return compressor.stream_writer(open(filename, 'wb'), closefd=True)
+
+# Function to return the suffix of a codec
+def codec_suffix(codec):
+  for suffix, name in compression_suffixes.items():
+    if name == codec:
+      return suffix
+  raise ValueError('Unknown codec ' + str(codec) + ', expected one of ' + str(list(compression_suffixes.values())))
+
+# Function to return the caches and indexes built next to an output file, which are stale once it's compressed
+def stale_sidecars(filename):
+  directory, name = os.path.split(filename)
+  sidecars = []
+  for entry in os.listdir(directory or '.'):
+    if entry.startswith(name + '.') and not is_compressed(entry):
+      sidecars.append(os.path.join(directory, entry))
+  return sidecars
+
+# Function to compress a single output file in place, returning the path of the compressed file
+#
+# The compressed file is written under a temporary name and moved into place before the original and
+# its stale caches are removed, so an interrupted compaction never loses output.
+def compress_output(filename, codec='zstd', level=None):
+  compressed_filename = filename + codec_suffix(codec)
+  tmp_filename = compressed_filename + '.tmp'
+  with open(filename, 'rb') as source, open_compressed(tmp_filename, codec, level) as destination:
+    shutil.copyfileobj(source, destination, 1 << 22)
+  shutil.copystat(filename, tmp_filename)
+  os.replace(tmp_filename, compressed_filename)
+
+  for sidecar in stale_sidecars(filename):
+    os.remove(sidecar)
+  os.remove(filename)
+  return compressed_filename
+
+# Function to compress the output files of a finished run directory, and any directories inside it
+#
+# patterns: file name patterns of the output to compress
+# Returns the total size in bytes of the files before and after compression.
+def compact_run(directory, codec='zstd', level=None, patterns=('*.txt',)):
+  size_before = 0
+  size_after = 0
+  for root, dirs, files in os.walk(directory):
+    for name in sorted(files):
+      if not any(fnmatch.fnmatch(name, pattern) for pattern in patterns):
+        continue
+      filename = os.path.join(root, name)
+      size_before += os.path.getsize(filename)
+      size_after += os.path.getsize(compress_output(filename, codec, level))
+  return size_before, size_after
+
+if __name__ == '__main__':
+  codec = sys.argv[2] if len(sys.argv) > 2 else 'zstd'
+  size_before, size_after = compact_run(sys.argv[1], codec)
+  print('Compacted ' + str(round(size_before / 1e6, 1)) + ' MB of output to ' + str(round(size_after / 1e6, 1)) + ' MB')
@@ -0,0 +1,153 @@
+import csv
+import json
+import os
+import numpy as np
+from scipy.optimize import differential_evolution
+
+# Checkpoint and resume for long differential evolution runs. Every checkpoint_every generations the
+# full population, its energies, the random generator state, the generation count and the run index
+# are written to an .npz file. Restarting the same run picks up from the last checkpoint: the saved
+# population is passed back as the initial population, its saved energies are returned for it without
+# re-running the simulations, and the random generator continues from the saved state.
+
+# Function to load a checkpoint file, returning None if it doesn't exist yet
+def load_checkpoint(checkpoint_filename):
+  if not os.path.exists(checkpoint_filename):
+    return None
+
+  with np.load(checkpoint_filename) as checkpoint:
+    return {
+      'run_index': int(checkpoint['run_index']),
+      'nit': int(checkpoint['nit']),
+      'finished': bool(checkpoint['finished']),
+      'population': checkpoint['population'],
+      'population_energies': checkpoint['population_energies'],
+      'rng_state': json.loads(str(checkpoint['rng_state'])),
+    }
+
+# Function to atomically write a checkpoint, so a crash mid-write leaves the previous one intact
+def save_checkpoint(checkpoint_filename, run_index, nit, finished, population, population_energies, rng):
+  tmp_filename = checkpoint_filename + '.tmp'
+  with open(tmp_filename, 'wb') as f:
+    np.savez(
+      f,
+      run_index=run_index,
+      nit=nit,
+      finished=finished,
+      population=population,
+      population_energies=population_energies,
+      rng_state=json.dumps(rng.bit_generator.state)
+    )
+  os.replace(tmp_filename, checkpoint_filename)
+
+# Function to open the per-iteration csv of a run for writing, keeping only the rows covered by its checkpoint
+#
+# Returns the open file, its csv writer and the number of iterations already written.
+def open_iteration_csv(filename, header, checkpoint_filename):
+  rows = []
+  checkpoint = load_checkpoint(checkpoint_filename)
+  if checkpoint is not None and os.path.exists(filename):
+    with open(filename, 'r') as old_f:
+      rows = list(csv.reader(old_f))[1:checkpoint['nit'] + 1]
+
+  f = open(filename, 'w')
+  writer = csv.writer(f)
+  writer.writerow(header)
+  writer.writerows(rows)
+  f.flush()
+  return f, writer, len(rows)
+
+# Objective wrapper returning the checkpointed energy for members of the restored population, and
+# evaluating anything else with the wrapped objective. It is a plain class so it can be sent to workers.
+#
+# With vectorized=True the wrapped objective takes an array of shape (N, S), as for
+# differential_evolution(vectorized=True), and only the unmatched columns are passed on to it.
+class RestoredObjective:
+  def __init__(self, func, population, population_energies, vectorized=False):
+    self.func = func
+    self.population = population
+    self.population_energies = population_energies
+    self.vectorized = vectorized
+
+  # Function to return the checkpointed energy of a single parameter vector, or None if it wasn't in the population
+  def restored_energy(self, x):
+    # The population is rescaled inside scipy, so members are matched with a tolerance rather than exactly
+    matches = np.flatnonzero(np.all(np.isclose(self.population, x, rtol=1e-10, atol=0), axis=1))
+    if len(matches) > 0:
+      return self.population_energies[matches[0]]
+    return None
+
+  def __call__(self, x):
+    if not self.vectorized:
+      energy = self.restored_energy(x)
+      return self.func(x) if energy is None else energy
+
+    x = np.asarray(x)
+    energies = np.empty(x.shape[1])
+    unmatched = []
+    for i, member in enumerate(x.T):
+      energy = self.restored_energy(member)
+      if energy is None:
+        unmatched.append(i)
+      else:
+        energies[i] = energy
+    if len(unmatched) > 0:
+      energies[unmatched] = self.func(x[:, unmatched])
+    return energies
+
+# Function to run differential_evolution with periodic checkpoints, resuming from checkpoint_filename if it exists
+#
+# Takes the same arguments as differential_evolution, plus the checkpoint file, how many generations
+# to run between checkpoints and the index of this run within a campaign of several runs. Returns the
+# scipy result, or None if the checkpoint shows this run has already finished.
+def resumable_differential_evolution(func, bounds, checkpoint_filename, checkpoint_every=1, run_index=0, maxiter=1000, callback=None, seed=None, **kwargs):
+  rng = np.random.default_rng(seed)
+  nit_done = 0
+
+  checkpoint = load_checkpoint(checkpoint_filename)
+  resumed = checkpoint is not None and checkpoint['run_index'] == run_index
+  # A map-like workers kept between runs, e.g. ScreenedPopulationMap, starts each run afresh
+  if hasattr(kwargs.get('workers'), 'reset'):
+    kwargs['workers'].reset(run_index, checkpoint['nit'] if resumed else 0)
+
+  if resumed:
+    if checkpoint['finished']:
+      return None
+
+    print('Resuming run ' + str(run_index) + ' from generation ' + str(checkpoint['nit']))
+    nit_done = checkpoint['nit']
+    rng.bit_generator.state = checkpoint['rng_state']
+    func = RestoredObjective(func, checkpoint['population'], checkpoint['population_energies'], kwargs.get('vectorized', False))
+    # A map-like workers which evaluates candidates itself, e.g. ScreenedPopulationMap, also needs the restored energies
+    if hasattr(kwargs.get('workers'), 'restore'):
+      kwargs['workers'].restore(func)
+    kwargs['init'] = checkpoint['population']
+    # x0 is already part of the restored population
+    kwargs.pop('x0', None)
+
+  def checkpointing_callback(intermediate_result):
+    nit = nit_done + intermediate_result.nit
+    if nit % checkpoint_every == 0:
+      save_checkpoint(
+        checkpoint_filename,
+        run_index,
+        nit,
+        False,
+        intermediate_result.population,
+        intermediate_result.population_energies,
+        rng
+      )
+    if callback is not None:
+      return callback(intermediate_result)
+
+  res = differential_evolution(
+    func,
+    bounds,
+    maxiter=max(maxiter - nit_done, 0),
+    callback=checkpointing_callback,
+    rng=rng,
+    **kwargs
+  )
+
+  save_checkpoint(checkpoint_filename, run_index, nit_done + res.nit, True, res.population, res.population_energies, rng)
+  return res
@@ -0,0 +1,136 @@
+import numpy as np
+from scipy.signal import fftconvolve
+
+# Fast 2D kernel density maps of atom positions, for every output step at once.
+#
+# Evaluating scipy's gaussian_kde directly on an n x n grid costs O(atoms * n^2) per frame. Here the
+# atoms of each frame are instead linearly binned onto the grid, and the binned counts convolved with
+# the same Gaussian kernel gaussian_kde would use (the data covariance scaled by Scott's or Silverman's
+# factor) through an FFT, which costs O(atoms + n^2 log n) per frame. The grid is padded by the kernel's
+# reach, truncate standard deviations, so atoms just outside the plotted region still contribute.
+# Atoms which escaped far from the trap widen the kernel, so the reach is capped at nbins grid points:
+# the padded grid is then at most 3 nbins across however far they are, and atoms outside it are dropped.
+
+# Function to return the bandwidth factor gaussian_kde uses for n points in d dimensions
+def bandwidth_factor(n, d=2, bw_method='scott'):
+  if bw_method == 'scott':
+    return n**(-1.0 / (d + 4))
+  if bw_method == 'silverman':
+    return (n * (d + 2) / 4.0)**(-1.0 / (d + 4))
+  return float(bw_method)
+
+# Function to return the kernel covariance of every frame, as gaussian_kde computes it from the data
+#
+# points: array of shape (frames, atoms, 2), NaN for missing atoms
+def kernel_covariances(points, bw_method='scott'):
+  present = ~np.isnan(points[:, :, 0])
+  counts = present.sum(axis=1)
+  filled = np.where(present[:, :, None], points, 0.0)
+  means = filled.sum(axis=1) / np.maximum(counts, 1)[:, None]
+  deviations = np.where(present[:, :, None], points - means[:, None, :], 0.0)
+  covariances = np.einsum('fai,faj->fij', deviations, deviations) / np.maximum(counts - 1, 1)[:, None, None]
+  factors = np.array([bandwidth_factor(n, 2, bw_method) if n > 0 else 1.0 for n in counts])
+  return covariances * factors[:, None, None]**2, counts
+
+# Function to linearly bin the points of every frame onto a grid, dropping points which fall outside it
+#
+# origin, spacing: position and spacing of the grid points along each axis
+# Returns counts of shape (frames, *shape)
+def linear_binning(points, origin, spacing, shape):
+  num_frames = points.shape[0]
+  u = (points - origin) / spacing
+  present = ~np.any(np.isnan(u), axis=2)
+  lower = np.floor(np.where(present[:, :, None], u, -1.0)).astype(np.int64)
+  weights = u - lower
+  inside = present & np.all((lower >= 0) & (lower < np.array(shape) - 1), axis=2)
+
+  frames = np.broadcast_to(np.arange(num_frames)[:, None], inside.shape)[inside]
+  i, j = lower[inside, 0], lower[inside, 1]
+  wx, wy = weights[inside, 0], weights[inside, 1]
+
+  # Each point is shared between the four grid points around it
+  counts = np.zeros(num_frames * shape[0] * shape[1])
+  for di, dj, w in ((0, 0, (1 - wx) * (1 - wy)), (1, 0, wx * (1 - wy)), (0, 1, (1 - wx) * wy), (1, 1, wx * wy)):
+    flat = (frames * shape[0] + i + di) * shape[1] + j + dj
+    counts += np.bincount(flat, weights=w, minlength=len(counts))
+  return counts.reshape((num_frames,) + tuple(shape))
+
+# Function to return the Gaussian kernel of every frame on a grid of offsets
+#
+# covariances: array of shape (frames, 2, 2)
+# reach: number of grid points the kernel extends to either side along each axis
+def gaussian_kernels(covariances, spacing, reach):
+  dx = spacing[0] * np.arange(-reach[0], reach[0] + 1)
+  dy = spacing[1] * np.arange(-reach[1], reach[1] + 1)
+  inverses = np.linalg.inv(covariances)
+  quadratic = (
+    inverses[:, 0, 0, None, None] * dx[None, :, None]**2
+    + 2 * inverses[:, 0, 1, None, None] * dx[None, :, None] * dy[None, None, :]
+    + inverses[:, 1, 1, None, None] * dy[None, None, :]**2
+  )
+  norms = 1.0 / (2 * np.pi * np.sqrt(np.linalg.det(covariances)))
+  return norms[:, None, None] * np.exp(-0.5 * quadratic)
+
+# Function to return density maps of the positions of every frame
+#
+# positions: array of shape (steps, atoms, 3), or (atoms, 3) for a single frame, NaN for missing atoms
+# x_range, y_range: (min, max) of the grid along the two plotted axes, whose points include both ends
+#   like np.mgrid[x_min:x_max:nbins*1j]
+# axes: the position components plotted along x and y, e.g. (0, 2) for the x-z plane
+# bw_method: 'scott', 'silverman' or a scalar factor, as for gaussian_kde
+# frame_batch: number of frames convolved together, to bound memory
+#
+# Returns the grid coordinates xi, yi of shape (nbins, nbins), as from np.mgrid, and densities of shape
+# (steps, nbins, nbins), or (nbins, nbins) for a single frame, normalised like gaussian_kde.
+def density_maps(positions, x_range, y_range, nbins=300, axes=(0, 2), bw_method='scott', truncate=4.0, frame_batch=16):
+  positions = np.asarray(positions, dtype=np.float64)
+  single_frame = positions.ndim == 2
+  if single_frame:
+    positions = positions[None]
+  points = positions[:, :, list(axes)]
+
+  origin = np.array([x_range[0], y_range[0]], dtype=np.float64)
+  spacing = (np.array([x_range[1], y_range[1]], dtype=np.float64) - origin) / (nbins - 1)
+  covariances, counts = kernel_covariances(points, bw_method)
+
+  densities = np.zeros((len(points), nbins, nbins))
+  for start in range(0, len(points), frame_batch):
+    batch = slice(start, start + frame_batch)
+    valid = counts[batch] > 1
+    if not np.any(valid):
+      continue
+    batch_covariances = covariances[batch][valid]
+
+    # The kernels of a batch share a size, set by its widest kernel
+    sigmas = np.sqrt(np.max(np.diagonal(batch_covariances, axis1=1, axis2=2), axis=0))
+    reach = np.minimum(np.ceil(truncate * sigmas / spacing), nbins).astype(np.int64)
+    padded_shape = (nbins + 2 * reach[0], nbins + 2 * reach[1])
+    binned = linear_binning(points[batch][valid], origin - reach * spacing, spacing, padded_shape)
+    kernels = gaussian_kernels(batch_covariances, spacing, reach)
+
+    maps = fftconvolve(binned, kernels, mode='valid', axes=(1, 2))
+    densities[start + np.flatnonzero(valid)] = np.maximum(maps, 0.0) / counts[batch][valid][:, None, None]
+
+  xi, yi = np.meshgrid(origin[0] + spacing[0] * np.arange(nbins), origin[1] + spacing[1] * np.arange(nbins), indexing='ij')
+  return xi, yi, densities[0] if single_frame else densities
+
+# Function to compare density_maps with gaussian_kde on a Gaussian cloud, optionally with a fraction of
+# the atoms escaped far outside the plotted region, returning the largest difference relative to the peak
+def check_against_kde(num_atoms=10000, nbins=100, escaped_fraction=0.0, escaped_distance=1000.0, seed=0):
+  from scipy.stats import gaussian_kde
+
+  rng = np.random.default_rng(seed)
+  positions = rng.normal(0.0, 1.0, (num_atoms, 3))
+  num_escaped = int(escaped_fraction * num_atoms)
+  positions[:num_escaped] = escaped_distance * (1.0 + rng.normal(0.0, 1.0, (num_escaped, 3)))
+
+  xi, yi, densities = density_maps(positions, (-3.0, 3.0), (-3.0, 3.0), nbins)
+  kde = gaussian_kde(positions[:, [0, 2]].T)(np.vstack([xi.ravel(), yi.ravel()])).reshape(xi.shape)
+  return np.max(np.abs(densities - kde)) / np.max(kde)
+
+if __name__ == '__main__':
+  for escaped_fraction in (0.0, 0.01):
+    error = check_against_kde(escaped_fraction=escaped_fraction)
+    print(str(escaped_fraction * 100) + '% escaped atoms: largest difference from gaussian_kde ' + str(round(error * 100, 3)) + '% of the peak')
+    if error > 0.01:
+      raise ValueError('density_maps differs from gaussian_kde by more than 1% of the peak')
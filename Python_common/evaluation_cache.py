@@ -0,0 +1,105 @@
+import atexit
+import json
+import os
+import sqlite3
+import time
+
+# Persistent memoisation of objective evaluations in an SQLite file, keyed by the simulation parameters.
+#
+# Parameters are canonicalised before lookup: the keys are sorted and floats are rounded to
+# significant_figures, so points which differential evolution re-proposes within that tolerance
+# share one entry. Results are stored as json, so a PSD, temperature or list of capture fractions
+# can all be cached. The least recently used entries are evicted once there are more than max_entries.
+#
+# Hit and miss counts are kept in the database too, so they cover every worker process and every run.
+# Lookups only read the database: each process counts its hits and misses, and the last use of the
+# entries it hit, in memory and writes them every flush_every lookups, at exit and when stats() is
+# called, so workers which only read don't queue on the SQLite write lock. Pool workers exit without
+# running atexit, so up to flush_every lookups per worker may be missing from the counts.
+class EvaluationCache:
+  def __init__(self, filename, significant_figures=8, max_entries=100000, flush_every=100):
+    self.filename = os.path.abspath(filename)
+    self.significant_figures = significant_figures
+    self.max_entries = max_entries
+    self.flush_every = flush_every
+    self.connection = None
+    self.pid = None
+    self.reset_pending()
+    atexit.register(self.flush)
+
+  # Function to clear the counts and uses not yet written to the database
+  def reset_pending(self):
+    self.pending_hits = 0
+    self.pending_misses = 0
+    self.pending_uses = {}
+
+  # Function to return a connection for this process, as sqlite connections can't be shared across a fork
+  def connect(self):
+    if self.connection is None or self.pid != os.getpid():
+      # Counts inherited from the parent across a fork are the parent's to write
+      if self.pid is not None:
+        self.reset_pending()
+      self.connection = sqlite3.connect(self.filename, timeout=60)
+      with self.connection:
+        self.connection.execute('CREATE TABLE IF NOT EXISTS evaluations (key TEXT PRIMARY KEY, result TEXT, last_used REAL)')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS evaluations_last_used ON evaluations (last_used)')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER)')
+        self.connection.execute("INSERT OR IGNORE INTO counters VALUES ('hits', 0), ('misses', 0)")
+      self.pid = os.getpid()
+    return self.connection
+
+  # Function to round a parameter value to the cache tolerance, leaving non-float values unchanged
+  def canonical_value(self, value):
+    if isinstance(value, float):
+      return float('%.*g' % (self.significant_figures, value))
+    return value
+
+  # Function to return the canonical key of a parameter dict
+  def key(self, params):
+    canonical = {name: self.canonical_value(value) for name, value in params.items()}
+    return json.dumps(canonical, sort_keys=True)
+
+  # Function to return the cached result for a parameter dict, or None on a miss
+  def get(self, params):
+    key = self.key(params)
+    connection = self.connect()
+    row = connection.execute('SELECT result FROM evaluations WHERE key = ?', (key,)).fetchone()
+    if row is None:
+      self.pending_misses += 1
+    else:
+      self.pending_hits += 1
+      self.pending_uses[key] = time.time()
+    if self.pending_hits + self.pending_misses >= self.flush_every:
+      self.flush()
+    return None if row is None else json.loads(row[0])
+
+  # Function to write this process's pending hit and miss counts and entry uses to the database
+  def flush(self):
+    if self.pid != os.getpid() or self.pending_hits + self.pending_misses == 0:
+      return
+    connection = self.connect()
+    with connection:
+      connection.executemany('UPDATE evaluations SET last_used = ? WHERE key = ?', [(used, key) for key, used in self.pending_uses.items()])
+      connection.execute("UPDATE counters SET value = value + ? WHERE name = 'hits'", (self.pending_hits,))
+      connection.execute("UPDATE counters SET value = value + ? WHERE name = 'misses'", (self.pending_misses,))
+    self.reset_pending()
+
+  # Function to store the result for a parameter dict, evicting the least recently used entries if the cache is full
+  def put(self, params, result):
+    connection = self.connect()
+    with connection:
+      connection.execute('INSERT OR REPLACE INTO evaluations VALUES (?, ?, ?)', (self.key(params), json.dumps(result), time.time()))
+      excess = connection.execute('SELECT COUNT(*) FROM evaluations').fetchone()[0] - self.max_entries
+      if excess > 0:
+        connection.execute(
+          'DELETE FROM evaluations WHERE key IN (SELECT key FROM evaluations ORDER BY last_used LIMIT ?)',
+          (excess,)
+        )
+
+  # Function to return the hit count, miss count and number of stored entries
+  def stats(self):
+    self.flush()
+    connection = self.connect()
+    counters = dict(connection.execute('SELECT name, value FROM counters').fetchall())
+    entries = connection.execute('SELECT COUNT(*) FROM evaluations').fetchone()[0]
+    return counters['hits'], counters['misses'], entries
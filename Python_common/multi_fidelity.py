@@ -0,0 +1,144 @@
+import csv
+import math
+import os
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+# Multi-fidelity screening for the shell trap objectives. Candidates are first scored with a cheap
+# configuration (fewer atoms, shorter run) and only the best 1/eta of them are promoted to the next,
+# more expensive level, up to the full configuration (successive halving).
+#
+# A fidelity level is a dict of overrides for standard_params, e.g. {'atom_number': 1000, 'num_steps': 2500},
+# and objectives take it as objective(x, fidelity=level). Values are only compared within a level, as
+# quantities such as the PSD scale with the number of atoms.
+
+# Function to run successive halving over a list of candidates
+#
+# evaluate: map-like callable used for each level, e.g. executor.map
+# full_fidelity_func: optional objective used instead of objective for the last level
+# Returns the value of each candidate, the index of the last fidelity level it was evaluated at, and a
+# list of every (candidate index, fidelity level, value) evaluation.
+def successive_halving(objective, candidates, fidelity_levels, eta=3, evaluate=map, full_fidelity_func=None):
+  values = np.full(len(candidates), np.inf)
+  levels = np.zeros(len(candidates), dtype=np.int64)
+  survivors = np.arange(len(candidates))
+  evaluations = []
+
+  for level, fidelity in enumerate(fidelity_levels):
+    if level == len(fidelity_levels) - 1 and full_fidelity_func is not None:
+      func = full_fidelity_func
+    else:
+      func = partial(objective, fidelity=fidelity)
+    values[survivors] = list(evaluate(func, [candidates[i] for i in survivors]))
+    levels[survivors] = level
+    evaluations += [(i, level, values[i]) for i in survivors]
+
+    if level < len(fidelity_levels) - 1:
+      num_promoted = max(math.ceil(len(survivors) / eta), 1)
+      survivors = survivors[np.argsort(values[survivors], kind='stable')[:num_promoted]]
+
+  return values, levels, evaluations
+
+# Map-like callable for the workers argument of differential_evolution, which screens each generation
+# with successive halving before evaluating the promoted candidates at full fidelity
+#
+# Candidates which aren't promoted to full fidelity are given an infinite energy, so they are never
+# accepted over a member evaluated at full fidelity. As a consequence the population energies stay
+# infinite until every member has been replaced by a full fidelity trial, and scipy's convergence
+# test (tol, atol) can't stop a run before then, which for a large eta is most of the run. Every
+# evaluation is logged with its run and fidelity level to log_filename, and the fidelity level behind
+# a reported value can be looked up with fidelity_level(x).
+#
+# One map can be shared by several runs: resumable_differential_evolution calls reset() at the start
+# of each, which clears the fidelity levels, restored population and generation count of the last.
+# When a checkpointed run is resumed it then passes its RestoredObjective to restore(), and candidates
+# from the restored population keep their checkpointed energies instead of being screened again.
+class ScreenedPopulationMap:
+  def __init__(self, objective, fidelity_levels, eta=3, num_workers=None, log_filename=None):
+    self.objective = objective
+    self.fidelity_levels = fidelity_levels
+    self.eta = eta
+    self.num_workers = num_workers
+    self.log_filename = log_filename
+    self.executor = None
+    self.reset()
+
+  # Function to start a new run, numbering its generations from generation
+  def reset(self, run_index=None, generation=0):
+    self.run_index = run_index
+    self.generation = generation
+    self.levels = {}
+    self.restored = None
+
+  # Function to set the RestoredObjective holding the energies of a resumed population
+  def restore(self, restored):
+    self.restored = restored
+
+  def __call__(self, func, iterable):
+    candidates = [np.asarray(x) for x in iterable]
+    energies = np.full(len(candidates), np.inf)
+    full_fidelity_level = len(self.fidelity_levels) - 1
+
+    # Members of a restored population keep their checkpointed energies, only the rest are screened
+    unknown = []
+    for i, x in enumerate(candidates):
+      energy = self.restored.restored_energy(x) if self.restored is not None else None
+      if energy is None:
+        unknown.append(i)
+      else:
+        energies[i] = energy
+        if np.isfinite(energy):
+          self.levels[tuple(x)] = full_fidelity_level
+
+    if len(unknown) > 0:
+      if self.executor is None and self.num_workers != 1:
+        self.executor = ProcessPoolExecutor(max_workers=self.num_workers)
+      evaluate = self.executor.map if self.executor is not None else map
+
+      # func is differential_evolution's wrapper of the full fidelity objective
+      screened = [candidates[i] for i in unknown]
+      values, levels, evaluations = successive_halving(
+        self.objective,
+        screened,
+        self.fidelity_levels,
+        self.eta,
+        evaluate=evaluate,
+        full_fidelity_func=func
+      )
+      self.log(screened, evaluations)
+      for x, level in zip(screened, levels):
+        self.levels[tuple(x)] = int(level)
+      energies[unknown] = np.where(levels == full_fidelity_level, values, np.inf)
+
+    self.generation += 1
+    return energies
+
+  # Function to return the fidelity level a candidate was last evaluated at
+  def fidelity_level(self, x):
+    return self.levels.get(tuple(np.asarray(x)))
+
+  # Function to append the evaluations of one generation to the log file
+  def log(self, candidates, evaluations):
+    if self.log_filename is None:
+      return
+
+    write_header = not os.path.exists(self.log_filename)
+    with open(self.log_filename, 'a') as f:
+      writer = csv.writer(f)
+      if write_header:
+        writer.writerow(['run', 'generation', 'fidelity level', 'atom number', 'number of steps', 'parameters', 'value'])
+      for i, level, value in evaluations:
+        fidelity = self.fidelity_levels[level]
+        writer.writerow([self.run_index, self.generation, level, fidelity.get('atom_number'), fidelity.get('num_steps'), candidates[i].tolist(), value])
+
+  def close(self):
+    if self.executor is not None:
+      self.executor.shutdown()
+      self.executor = None
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc):
+    self.close()
@@ -0,0 +1,119 @@
+import warnings
+import numpy as np
+from scipy.signal import welch
+
+# Oscillation spectra of atom trajectories in the shell trap, for every atom and axis at once.
+#
+# Trajectories are (steps, atoms, 3) arrays as returned by load_output, sampled every sample_spacing
+# seconds. A single rfft along the time axis gives the spectra of all atoms and axes, from which the
+# dominant frequency of each atom, the ensemble averaged spectrum and a Welch estimate of it follow.
+# Atoms are processed in batches of atom_batch, so the spectra of a whole run are never held at once.
+# Atoms which are missing from any step (NaN positions) are left out.
+
+# Function to return the sample spacing in seconds of output written at the given steps
+def sample_spacing(steps, timestep):
+  return float(steps[1] - steps[0]) * timestep
+
+# Function to return the frequencies and FFT amplitudes of trajectories, of shape (frequencies, atoms, 3)
+#
+# remove_mean: subtract each trajectory's mean first, so the zero frequency doesn't dominate
+def amplitude_spectra(trajectories, spacing, remove_mean=False):
+  trajectories = np.asarray(trajectories, dtype=np.float64)
+  if remove_mean:
+    trajectories = trajectories - trajectories.mean(axis=0)
+  frequencies = np.fft.rfftfreq(trajectories.shape[0], spacing)
+  return frequencies, np.abs(np.fft.rfft(trajectories, axis=0))
+
+# Function to return the index of the frequencies inside [min_frequency, max_frequency]
+def frequency_band(frequencies, min_frequency=None, max_frequency=None):
+  # The zero frequency is always excluded
+  lower = frequencies[1] if min_frequency is None else max(min_frequency, frequencies[1])
+  upper = frequencies[-1] if max_frequency is None else max_frequency
+  return np.flatnonzero((frequencies >= lower) & (frequencies <= upper))
+
+# Function to return the frequency and amplitude of the highest peak of each spectrum in a band
+#
+# The peak is refined between bins by fitting a parabola through the log amplitudes around it.
+def dominant_frequencies(frequencies, amplitudes, band):
+  band_amplitudes = amplitudes[band]
+  peaks = np.argmax(band_amplitudes, axis=0)
+  peak_amplitudes = np.take_along_axis(band_amplitudes, peaks[None], axis=0)[0]
+
+  # Parabolic interpolation needs a neighbour on either side, at the band edges the bin itself is used
+  inner = (peaks > 0) & (peaks < len(band) - 1)
+  below = np.take_along_axis(band_amplitudes, np.clip(peaks - 1, 0, len(band) - 1)[None], axis=0)[0]
+  above = np.take_along_axis(band_amplitudes, np.clip(peaks + 1, 0, len(band) - 1)[None], axis=0)[0]
+  with np.errstate(divide='ignore', invalid='ignore'):
+    log_below, log_peak, log_above = np.log(below), np.log(peak_amplitudes), np.log(above)
+    curvature = log_below - 2 * log_peak + log_above
+    shift = np.where(inner & (curvature < 0), 0.5 * (log_below - log_above) / curvature, 0.0)
+
+  bin_width = frequencies[1] - frequencies[0]
+  return frequencies[band][peaks] + np.nan_to_num(shift) * bin_width, peak_amplitudes
+
+# Function to return the oscillation spectra statistics of every atom and axis of a run
+#
+# min_frequency, max_frequency: band searched for each atom's dominant frequency, in Hz
+# nperseg: segment length of the Welch estimate, in samples
+#
+# Returns a dict of
+#   frequencies: rfft frequencies, in Hz
+#   mean_spectrum: (frequencies, 3) amplitude spectrum averaged over the atoms
+#   welch_frequencies, welch_spectrum: Welch power spectral density averaged over the atoms, (frequencies, 3)
+#   dominant_frequencies, dominant_amplitudes: (atoms, 3) highest peak in the band of each atom and axis,
+#     NaN for the atoms left out
+def oscillation_spectra(trajectories, spacing, min_frequency=None, max_frequency=None, nperseg=256, atom_batch=1000):
+  num_steps, num_atoms = trajectories.shape[:2]
+  frequencies = np.fft.rfftfreq(num_steps, spacing)
+  band = frequency_band(frequencies, min_frequency, max_frequency)
+  nperseg = min(nperseg, num_steps)
+
+  spectrum_sum = np.zeros((len(frequencies), 3))
+  welch_sum = np.zeros((nperseg // 2 + 1, 3))
+  num_complete = 0
+  dominant = np.full((num_atoms, 3), np.nan)
+  dominant_amplitudes = np.full((num_atoms, 3), np.nan)
+
+  for start in range(0, num_atoms, atom_batch):
+    batch = np.asarray(trajectories[:, start:start + atom_batch], dtype=np.float64)
+    complete = ~np.any(np.isnan(batch), axis=(0, 2))
+    if not np.any(complete):
+      continue
+    batch = batch[:, complete]
+
+    _, amplitudes = amplitude_spectra(batch, spacing, remove_mean=True)
+    spectrum_sum += amplitudes.sum(axis=1)
+    welch_frequencies, power = welch(batch, fs=1.0 / spacing, nperseg=nperseg, axis=0)
+    welch_sum += power.sum(axis=1)
+    num_complete += batch.shape[1]
+
+    atoms = start + np.flatnonzero(complete)
+    dominant[atoms], dominant_amplitudes[atoms] = dominant_frequencies(frequencies, amplitudes, band)
+
+  return {
+    'frequencies': frequencies,
+    'mean_spectrum': spectrum_sum / max(num_complete, 1),
+    'welch_frequencies': np.fft.rfftfreq(nperseg, spacing),
+    'welch_spectrum': welch_sum / max(num_complete, 1),
+    'dominant_frequencies': dominant,
+    'dominant_amplitudes': dominant_amplitudes,
+  }
+
+# Function to compare the dominant frequencies of each axis with a theoretical resonance
+#
+# tolerance: distance from the resonance, in Hz, within which an atom counts as oscillating at it
+# Returns a dict of per-axis arrays: number of atoms, mean, median and stdev of the dominant
+# frequencies, the mean offset from the resonance and the fraction of atoms within tolerance of it.
+def resonance_comparison(dominant, resonance=132.0, tolerance=5.0):
+  valid = ~np.isnan(dominant)
+  # Axes without any atoms are left NaN, without warning about the empty slices
+  with warnings.catch_warnings():
+    warnings.simplefilter('ignore', RuntimeWarning)
+    return {
+      'number of atoms': valid.sum(axis=0),
+      'mean': np.nanmean(dominant, axis=0),
+      'median': np.nanmedian(dominant, axis=0),
+      'stdev': np.nanstd(dominant, axis=0),
+      'mean offset': np.nanmean(dominant, axis=0) - resonance,
+      'fraction within tolerance': np.sum(valid & (np.abs(dominant - resonance) <= tolerance), axis=0) / np.maximum(valid.sum(axis=0), 1),
+    }
@@ -0,0 +1,105 @@
+import os
+import numpy as np
+
+from atomecs_output import fill_frame, iter_frames, load_step_index, parse_records
+from compressed_output import is_compressed, open_output, resolve_output
+from parallel_output import parse_parallel
+
+# Binary cache of AtomECS Text output. A text file such as `pos.txt` is converted once into
+#
+#   pos.txt.npy       (steps, atoms, 3) float32 block of values
+#   pos.txt.meta.npz  step numbers, atom ids and the size/mtime of the source file
+#
+# Later loads memory map the block, so a plot only reads the pages of the steps and atoms it uses.
+# The cache is rebuilt whenever the source file's size or mtime changes. Files larger than
+# parallel_threshold are parsed in chunks on a process pool, each writing straight into the block.
+# A compressed output file (see compressed_output) is cached under its own name, e.g. pos.txt.zst.npy.
+
+parallel_threshold = 1 << 26
+
+# Function to return the paths of the value block and header of the cache for an output file
+def cache_paths(filename):
+  return str(filename) + '.npy', str(filename) + '.meta.npz'
+
+# Function to check whether the cache of an output file exists and was built from its current contents
+def cache_is_valid(filename):
+  values_path, meta_path = cache_paths(filename)
+  if not (os.path.exists(values_path) and os.path.exists(meta_path)):
+    return False
+
+  stat = os.stat(filename)
+  with np.load(meta_path) as meta:
+    return meta['size'] == stat.st_size and meta['mtime_ns'] == stat.st_mtime_ns
+
+# Function to convert an output file into the binary cache, streaming frame by frame into the memory mapped block
+#
+# num_workers: number of processes parsing large files, defaults to one per core
+def convert_output(filename, dtype=np.float32, num_workers=None):
+  filename = resolve_output(filename)
+  values_path, meta_path = cache_paths(filename)
+  stat = os.stat(filename)
+  index = load_step_index(filename)
+  steps = index[0]
+
+  # The atoms present in the first frame define the columns, later frames may only lose atoms
+  atom_ids = np.empty(0, dtype=np.int64)
+  if len(steps) > 0:
+    with open_output(filename) as f:
+      step, count, records = next(iter_frames(f))
+    atom_ids = np.sort(parse_records(records)[0])
+
+  # Write to temporary names and move into place at the end, so an interrupted conversion is never loaded
+  values_tmp = values_path + '.tmp'
+  values = np.lib.format.open_memmap(values_tmp, mode='w+', dtype=dtype, shape=(len(steps), len(atom_ids), 3))
+  # Compressed files can only be read sequentially
+  if stat.st_size > parallel_threshold and num_workers != 1 and values.size > 0 and not is_compressed(filename):
+    parse_parallel(filename, index, values_tmp, values.offset, values.shape, dtype, atom_ids, num_workers)
+  else:
+    with open_output(filename) as f:
+      for i, (step, count, records) in enumerate(iter_frames(f)):
+        frame_ids, frame_values = parse_records(records, dtype)
+        fill_frame(values[i], atom_ids, frame_ids, frame_values)
+  values.flush()
+  del values
+
+  meta_tmp = meta_path + '.tmp'
+  with open(meta_tmp, 'wb') as f:
+    np.savez(f, steps=steps, atom_ids=atom_ids, size=stat.st_size, mtime_ns=stat.st_mtime_ns)
+
+  os.replace(values_tmp, values_path)
+  os.replace(meta_tmp, meta_path)
+
+# Function to load an output file through the binary cache, converting it first if needed
+#
+# Takes the same atoms and steps selections as read_output and returns the step numbers, atom ids
+# and values. Without a selection the values are the read-only memory map itself, so nothing is
+# read from disk until it is indexed.
+def load_output(filename, atoms=None, steps=None):
+  filename = resolve_output(filename)
+  if not cache_is_valid(filename):
+    convert_output(filename)
+
+  values_path, meta_path = cache_paths(filename)
+  with np.load(meta_path) as meta:
+    step_numbers = meta['steps']
+    atom_ids = meta['atom_ids']
+  values = np.load(values_path, mmap_mode='r')
+
+  if steps is not None:
+    selected = np.array([step in steps for step in step_numbers], dtype=bool)
+    step_numbers = step_numbers[selected]
+    values = values[selected]
+
+  if atoms is not None:
+    requested = np.sort(np.asarray(atoms, dtype=np.int64))
+    columns = np.searchsorted(atom_ids, requested)
+    columns[columns == len(atom_ids)] = 0
+    found = atom_ids[columns] == requested if len(atom_ids) > 0 else np.zeros(len(requested), dtype=bool)
+
+    # Atoms not in the cache are returned as NaN, matching read_output
+    selection = np.full((len(step_numbers), len(requested), 3), np.nan, dtype=values.dtype)
+    selection[:, found] = values[:, columns[found]]
+    atom_ids = requested
+    values = selection
+
+  return step_numbers, atom_ids, values
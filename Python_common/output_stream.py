@@ -0,0 +1,132 @@
+import json
+import os
+import threading
+
+from atomecs_output import iter_frames, parse_records
+from simulation_runner import worker_sandbox
+
+# Streaming of AtomECS output straight into Python reducers, without writing the text output to disk.
+#
+# The output files an example writes (e.g. shell_trap_output/pos.txt) are replaced in the sandbox by
+# named pipes before the simulation starts. AtomECS opens and writes them like normal files, and a
+# reader thread per pipe parses each frame as it is produced and hands it to a reducer, so the
+# analysis runs alongside the simulation and the frames are never stored.
+#
+# A reducer is any object with two methods:
+#
+#   wants(step): whether the frame at this step is needed, frames which aren't are skipped unparsed
+#   add_frame(step, atom_ids, values): called with the parsed frame, values has shape (atoms, 3)
+
+# Function to replace a file in the sandbox with a named pipe
+def make_pipe(path):
+  if os.path.lexists(path):
+    os.remove(path)
+  os.mkfifo(path)
+
+# Function to read every frame from a pipe into a reducer, storing any exception so it can be raised by the caller
+def consume_pipe(path, reducer, errors):
+  with open(path, 'rb') as f:
+    try:
+      for step, count, records in iter_frames(f):
+        if reducer.wants(step):
+          atom_ids, values = parse_records(records)
+          reducer.add_frame(step, atom_ids, values)
+    except Exception as e:
+      errors.append(e)
+      # Keep draining the pipe, so the simulation isn't left blocked on a full pipe
+      for line in f:
+        pass
+
+# Function to release a reader thread still waiting for the simulation to open its pipe, e.g. when the
+# simulation failed to start, by opening and closing the write end
+def release_pipe(path):
+  try:
+    fd = os.open(path, os.O_WRONLY | os.O_NONBLOCK)
+  except OSError:
+    return
+  os.close(fd)
+
+# Function to run a simulation in this process's sandbox, streaming its output files into reducers
+#
+# runner: SimulationRunner for the example to run
+# params: dict written as json to input_filename inside the sandbox
+# reducers: dict of reducers keyed by output file path relative to the sandbox, e.g. 'shell_trap_output/vel.txt'
+# supervisor: optional Supervisor which can stop the run early (see SimulationRunner.run)
+#
+# Returns False if the supervisor stopped the run, in which case the reducers only saw part of it.
+def stream_simulation(runner, params, reducers, input_filename='input.json', scratch_root='sandboxes', supervisor=None):
+  output_dirs = set(os.path.dirname(filename) for filename in reducers)
+  sandbox = worker_sandbox(scratch_root, tuple(output_dirs))
+  with open(os.path.join(sandbox, input_filename), 'w') as f:
+    json.dump(params, f)
+    f.flush()
+
+  errors = []
+  readers = []
+  for filename, reducer in reducers.items():
+    path = os.path.join(sandbox, filename)
+    make_pipe(path)
+    reader = threading.Thread(target=consume_pipe, args=(path, reducer, errors), daemon=True)
+    reader.start()
+    readers.append((path, reader))
+
+  try:
+    completed = runner.run(cwd=sandbox, supervisor=supervisor) is not None
+  finally:
+    for path, reader in readers:
+      while reader.is_alive():
+        release_pipe(path)
+        reader.join(0.1)
+      # Leave no pipes behind for a later run in this sandbox which writes files
+      os.remove(path)
+
+  if len(errors) > 0:
+    raise errors[0]
+  return completed
+
+# Reducer pairing the frames of two output components at the same steps, e.g. positions and velocities,
+# and calling func(step, first_values, second_values) once both have arrived. The two components are read
+# on separate threads, so frames are matched under a lock and only unmatched frames are kept.
+class PairedFrames:
+  def __init__(self, steps, func):
+    self.steps = set(int(step) for step in steps)
+    self.func = func
+    self.pending = [{}, {}]
+    self.results = {}
+    self.lock = threading.Lock()
+
+  # Function to return the reducer for one of the two components (0 or 1)
+  def component(self, index):
+    return PairedComponent(self, index)
+
+  def add(self, index, step, values):
+    with self.lock:
+      other = self.pending[1 - index].pop(step, None)
+      if other is None:
+        self.pending[index][step] = values
+        return
+    pair = (values, other) if index == 0 else (other, values)
+    self.results[step] = self.func(step, *pair)
+
+  # Function to return the steps which haven't been paired yet, in order
+  def missing_steps(self):
+    return sorted(self.steps.difference(self.results))
+
+  # Function to return the results in step order, raising a ValueError unless every requested step was paired
+  def ordered_results(self):
+    missing = self.missing_steps()
+    if len(missing) > 0:
+      raise ValueError('Steps ' + str(missing) + ' are missing from the streamed output')
+    return [self.results[step] for step in sorted(self.results)]
+
+# One side of a PairedFrames reducer
+class PairedComponent:
+  def __init__(self, paired, index):
+    self.paired = paired
+    self.index = index
+
+  def wants(self, step):
+    return step in self.paired.steps
+
+  def add_frame(self, step, atom_ids, values):
+    self.paired.add(self.index, step, values)
@@ -0,0 +1,138 @@
+import io
+import os
+import shutil
+import sys
+import tempfile
+import time
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+
+from atomecs_output import fill_frame, iter_frames, load_step_index, parse_records, read_indexed_frame, read_output
+from compressed_output import is_compressed, resolve_output
+
+# Chunk-parallel parsing of AtomECS Text output, for multi-gigabyte files where a single core spends
+# most of its time converting text to floats.
+#
+# The step index gives the byte offset of every `step-` header, so a file can be split into byte ranges
+# holding whole frames. Each range is parsed by a worker process, which writes its frames straight
+# into its rows of a memory mapped (steps, atoms, 3) array shared with every other worker and the
+# caller, so no parsed values are sent between processes. The array is either a file such as the
+# output_cache `.npy` block, or for an in-memory read a temporary file in shared memory (/dev/shm)
+# which is unlinked once parsed, leaving the caller's mapping as the only reference to it. Shared
+# memory is often small (64 MB in a default Docker container), so arrays which don't fit in it are
+# backed by a temporary file on disk instead.
+
+# Directory of the temporary files behind in-memory reads, RAM backed where available
+shared_memory_dir = '/dev/shm' if os.path.isdir('/dev/shm') else None
+
+# Function to return a directory with room for a temporary file of size bytes, preferring shared memory
+def temporary_dir(size):
+  for directory in ([shared_memory_dir] if shared_memory_dir is not None else []) + [tempfile.gettempdir()]:
+    if shutil.disk_usage(directory).free >= size:
+      return directory
+  raise OSError('No room for a ' + str(round(size / 1e6, 1)) + ' MB temporary file in shared memory or ' + tempfile.gettempdir())
+
+# Function to split the frames of a step index into about num_chunks ranges of similar byte size
+#
+# Returns a list of (first frame, end frame) pairs, each range starting at a frame header
+def chunk_ranges(index, file_size, num_chunks):
+  offsets = index[1]
+  if len(offsets) == 0:
+    return []
+  targets = np.linspace(offsets[0], file_size, num_chunks + 1)[1:-1]
+  boundaries = np.unique(np.concatenate([[0], np.searchsorted(offsets, targets), [len(offsets)]]))
+  return [(int(start), int(end)) for start, end in zip(boundaries[:-1], boundaries[1:]) if end > start]
+
+# Function to parse frames [start, end) of an output file into rows of a shared memory mapped array
+#
+# values_path, offset, shape: the array file, the byte offset of its data and its full shape
+def parse_chunk(filename, index, start, end, values_path, offset, shape, dtype, atom_ids):
+  steps, offsets, counts = index
+  with open(filename, 'rb') as f:
+    f.seek(offsets[start])
+    data = f.read((offsets[end] if end < len(offsets) else os.path.getsize(filename)) - offsets[start])
+
+  values = np.memmap(values_path, dtype=dtype, mode='r+', offset=offset, shape=shape)
+  for row, (step, count, records) in enumerate(iter_frames(io.BytesIO(data)), start):
+    frame_ids, frame_values = parse_records(records, dtype)
+    fill_frame(values[row], atom_ids, frame_ids, frame_values)
+  values.flush()
+  return len(data)
+
+# Function to parse every frame of an output file into a shared memory mapped array on a process pool
+#
+# values_path, offset: file holding the (steps, atoms, 3) array and the byte offset of its data, which
+#   must already have the right size
+# chunks_per_worker: more chunks than workers keep the pool busy when frames differ in size
+def parse_parallel(filename, index, values_path, offset, shape, dtype, atom_ids, num_workers=None, chunks_per_worker=4):
+  num_workers = num_workers or os.cpu_count()
+  ranges = chunk_ranges(index, os.path.getsize(filename), num_workers * chunks_per_worker)
+  with ProcessPoolExecutor(max_workers=num_workers) as executor:
+    futures = [
+      executor.submit(parse_chunk, filename, index, start, end, values_path, offset, shape, dtype, atom_ids)
+      for start, end in ranges
+    ]
+    for future in futures:
+      future.result()
+
+# Function to return the atom ids of the first frame of a step index, the columns used when no atoms are requested
+def first_frame_atom_ids(filename, index):
+  if len(index[0]) == 0:
+    return np.empty(0, dtype=np.int64)
+  with open(filename, 'rb') as f:
+    frame_ids, frame_values = parse_records(read_indexed_frame(f, index, 0))
+  return np.sort(frame_ids)
+
+# Function to read an AtomECS Text output file into a (steps, atoms, 3) array using num_workers processes
+#
+# Takes the same atoms selection and returns the same step numbers, atom ids and values as read_output.
+# The values are a memory map of a temporary file, in shared memory if it fits, which lives as long as the array.
+# Compressed files can only be read sequentially, so they're read with read_output.
+def read_output_parallel(filename, atoms=None, dtype=np.float64, num_workers=None):
+  filename = resolve_output(filename)
+  if is_compressed(filename):
+    return read_output(filename, atoms=atoms, dtype=dtype)
+  index = load_step_index(filename)
+  atom_ids = first_frame_atom_ids(filename, index) if atoms is None else np.sort(np.asarray(atoms, dtype=np.int64))
+  shape = (len(index[0]), len(atom_ids), 3)
+  if 0 in shape:
+    return read_output(filename, atoms=atoms, dtype=dtype)
+
+  # ftruncate doesn't reserve the space, so running out of it part way would only show up as a SIGBUS in a worker
+  size = int(np.prod(shape)) * np.dtype(dtype).itemsize
+  fd, values_path = tempfile.mkstemp(suffix='.npy', dir=temporary_dir(size))
+  try:
+    os.ftruncate(fd, size)
+    values = np.memmap(values_path, dtype=dtype, mode='r+', shape=shape)
+    parse_parallel(filename, index, values_path, 0, shape, dtype, atom_ids, num_workers)
+  finally:
+    os.close(fd)
+    os.remove(values_path)
+
+  return index[0], atom_ids, values
+
+# Function to time reading an output file serially with read_output and in parallel with each worker count
+#
+# Returns a dict of throughputs in MB/s of the source file, keyed by worker count with 'serial' for read_output
+def benchmark(filename, worker_counts=None, dtype=np.float64):
+  size = os.path.getsize(filename) / 1e6
+  # Build the step index up front, so neither path is charged for it
+  load_step_index(filename)
+
+  start = time.perf_counter()
+  serial = read_output(filename, dtype=dtype)
+  throughputs = {'serial': size / (time.perf_counter() - start)}
+
+  for num_workers in worker_counts or sorted(set([1, 2, 4, os.cpu_count()])):
+    start = time.perf_counter()
+    parallel = read_output_parallel(filename, dtype=dtype, num_workers=num_workers)
+    throughputs[num_workers] = size / (time.perf_counter() - start)
+    if not np.array_equal(serial[2], parallel[2], equal_nan=True):
+      raise ValueError('Parallel read with ' + str(num_workers) + ' workers differs from read_output')
+    del parallel
+
+  return throughputs
+
+if __name__ == '__main__':
+  for workers, throughput in benchmark(sys.argv[1]).items():
+    print(str(workers) + (' workers' if workers != 'serial' else '') + ': ' + str(round(throughput, 1)) + ' MB/s')
@@ -0,0 +1,58 @@
+import numpy as np
+
+# Vectorised phase space density of the shell trap, for many frames and bounding box sizes at once.
+#
+# For each frame the bounding box is the slab |x| < half width around the trap centre, with
+# half width = 0.5 * box_fraction * (x range of the cloud), and
+#
+#   PSD = n / <KE>^1.5,  n = (atoms in the box) / (2 * half width)^3
+#
+# where <KE> is the mean kinetic energy of the atoms in the box. Each frame's atoms are sorted by |x|
+# once, so the atoms inside every box width are a prefix of the sorted order. The counts come from a
+# single searchsorted over all frames and the kinetic energy sums from a cumulative sum.
+
+# Function to return the number of atoms, mean KE and PSD inside each bounding box of each frame
+#
+# positions, velocities: arrays of shape (steps, atoms, 3) with matching atom order, as returned by
+#   read_output. Atoms missing from a frame (NaN positions) are ignored.
+# box_fractions: bounding box sizes as fractions of the x range, the PSD objective uses 0.05
+#
+# Returns bounded atom counts, mean KEs and PSDs, each of shape (steps, len(box_fractions)). Boxes with
+# no atoms in them have a NaN mean KE and PSD.
+def phase_space_density(positions, velocities, mass=1.0, box_fractions=(0.05,)):
+  positions = np.asarray(positions, dtype=np.float64)
+  velocities = np.asarray(velocities, dtype=np.float64)
+  num_steps, num_atoms = positions.shape[:2]
+  box_fractions = np.asarray(box_fractions, dtype=np.float64)
+
+  x = positions[:, :, 0]
+  present = ~np.isnan(x)
+  with np.errstate(invalid='ignore'):
+    x_range = np.nanmax(x, axis=1, initial=-np.inf, where=present) - np.nanmin(x, axis=1, initial=np.inf, where=present)
+  half_widths = 0.5 * box_fractions[None, :] * x_range[:, None]
+
+  # Sort each frame by |x|, with missing atoms placed after every real atom
+  abs_x = np.abs(x)
+  out_of_range = np.nanmax(abs_x, initial=0.0) + 1.0
+  abs_x[~present] = out_of_range
+  order = np.argsort(abs_x, axis=1)
+  sorted_abs_x = np.take_along_axis(abs_x, order, axis=1)
+  KEs = 0.5 * mass * np.sum(velocities**2, axis=2)
+  KEs[~present] = 0.0
+  cumulative_KEs = np.concatenate([np.zeros((num_steps, 1)), np.cumsum(np.take_along_axis(KEs, order, axis=1), axis=1)], axis=1)
+
+  # Offset each frame into its own interval so one searchsorted covers every frame, counting atoms strictly inside the box
+  frame_offsets = 2 * out_of_range * np.arange(num_steps)
+  counts = np.searchsorted(
+    (sorted_abs_x + frame_offsets[:, None]).ravel(),
+    (np.minimum(np.nan_to_num(half_widths, nan=0.0), out_of_range) + frame_offsets[:, None]).ravel(),
+    side='left'
+  ).reshape(num_steps, len(box_fractions)) - num_atoms * np.arange(num_steps)[:, None]
+
+  with np.errstate(divide='ignore', invalid='ignore'):
+    mean_KEs = np.take_along_axis(cumulative_KEs, counts, axis=1) / counts
+    mean_KEs[counts == 0] = np.nan
+    density = counts / (2 * half_widths)**3
+    PSDs = density / mean_KEs**1.5
+
+  return counts, mean_KEs, PSDs
@@ -0,0 +1,119 @@
+import csv
+import json
+import os
+import numpy as np
+
+# Columnar store for capture fraction sweep results, replacing csv cells holding a python list literal.
+#
+# The file is a fixed size json header followed by binary records, one per simulation:
+#
+#   offset delta (f8), detuning (f8), number of steps (i8), repeat (i8), capture fraction (f8)
+#
+# Records are only ever appended, each with a single write, so sweeps can add results as they finish and
+# a crash can at worst leave a partial last record. It is ignored when loading, and cut off before the
+# next append so later records stay aligned. Loading is a single
+# np.fromfile, and load_capture_fractions arranges the records into an (offsets, detunings, repeats) array.
+
+record_dtype = np.dtype([
+  ('offset delta', '<f8'),
+  ('detuning', '<f8'),
+  ('number of steps', '<i8'),
+  ('repeat', '<i8'),
+  ('capture fraction', '<f8'),
+])
+
+header_size = 512
+store_format = 'capture fraction results'
+store_version = 1
+
+# Function to create an empty store with its header, unless the file already exists
+def create_store(filename):
+  if os.path.exists(filename):
+    return
+
+  header = json.dumps({
+    'format': store_format,
+    'version': store_version,
+    'dtype': [[name, record_dtype[name].str] for name in record_dtype.names],
+  }).encode()
+  tmp_filename = filename + '.tmp'
+  with open(tmp_filename, 'wb') as f:
+    f.write(header.ljust(header_size - 1) + b'\n')
+  os.replace(tmp_filename, filename)
+
+# Function to check the header of a store
+def read_header(filename):
+  with open(filename, 'rb') as f:
+    header = json.loads(f.read(header_size))
+  if header.get('format') != store_format or header.get('version') != store_version:
+    raise ValueError(filename + ' is not a version ' + str(store_version) + ' capture fraction results store')
+  return header
+
+# Function to append results to a store, creating it if needed. Arguments are broadcast against each other.
+def append_results(filename, offset_deltas, detunings, number_of_steps, repeats, capture_fractions):
+  create_store(filename)
+  columns = np.broadcast_arrays(offset_deltas, detunings, number_of_steps, repeats, capture_fractions)
+  records = np.empty(columns[0].size, dtype=record_dtype)
+  for name, column in zip(record_dtype.names, columns):
+    records[name] = column.ravel()
+
+  fd = os.open(filename, os.O_WRONLY | os.O_APPEND)
+  try:
+    # Drop a partial record left by an interrupted append, which would misalign every record after it
+    size = os.fstat(fd).st_size
+    complete_size = header_size + (size - header_size) // record_dtype.itemsize * record_dtype.itemsize
+    if complete_size != size:
+      os.ftruncate(fd, complete_size)
+    os.write(fd, records.tobytes())
+  finally:
+    os.close(fd)
+
+# Function to load every complete record of a store as a structured array
+def load_records(filename):
+  read_header(filename)
+  num_records = (os.path.getsize(filename) - header_size) // record_dtype.itemsize
+  return np.fromfile(filename, dtype=record_dtype, count=num_records, offset=header_size)
+
+# Function to load the capture fractions of a store as a grid
+#
+# number_of_steps: only use records with this number of steps, needed if the store holds several
+#
+# Returns the sorted offset deltas, the sorted detunings and an (offsets, detunings, repeats) array of
+# capture fractions, NaN where a grid point has fewer repeats. A repeat stored twice keeps its last value.
+def load_capture_fractions(filename, number_of_steps=None):
+  records = load_records(filename)
+  if number_of_steps is not None:
+    records = records[records['number of steps'] == number_of_steps]
+  elif len(np.unique(records['number of steps'])) > 1:
+    raise ValueError(filename + ' holds several numbers of steps, so one has to be chosen')
+
+  offset_deltas, offset_index = np.unique(records['offset delta'], return_inverse=True)
+  detunings, detuning_index = np.unique(records['detuning'], return_inverse=True)
+  num_repeats = records['repeat'].max() + 1 if len(records) > 0 else 0
+
+  capture_fractions = np.full((len(offset_deltas), len(detunings), num_repeats), np.nan)
+  capture_fractions[offset_index, detuning_index, records['repeat']] = records['capture fraction']
+  return offset_deltas, detunings, capture_fractions
+
+# Function to parse a csv cell holding a list of numbers, e.g. '[0.1, 0.25, 0.0]', without evaluating it
+def parse_number_list(cell):
+  return np.fromstring(cell.strip().strip('[]'), sep=',')
+
+# Function to convert a sweep csv with one capture fraction list per row into a new store
+def convert_csv(csv_filename, store_filename):
+  if os.path.exists(store_filename):
+    raise ValueError(store_filename + ' already exists')
+
+  columns = [[], [], [], [], []]
+  with open(csv_filename, 'r') as f:
+    for line in csv.DictReader(f):
+      capture_fractions = parse_number_list(line['capture fraction array'])
+      columns[0].append(np.full(len(capture_fractions), float(line['offset delta'])))
+      columns[1].append(np.full(len(capture_fractions), float(line['detuning'])))
+      columns[2].append(np.full(len(capture_fractions), int(line['number of steps'])))
+      columns[3].append(np.arange(len(capture_fractions)))
+      columns[4].append(capture_fractions)
+
+  # The whole csv is parsed before anything is written, so a malformed csv leaves no partial store behind
+  create_store(store_filename)
+  append_results(store_filename, *[np.concatenate(column) if len(column) > 0 else np.empty(0) for column in columns])
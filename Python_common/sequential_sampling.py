@@ -0,0 +1,32 @@
+import numpy as np
+
+# Stopping rule for sequential sampling of repeated stochastic simulations. A grid point keeps
+# getting more repeats until the uncertainty on its mean drops below a target, so points whose
+# capture fraction is always 0 (or settles quickly) stop early and the budget goes to noisy points.
+
+# Function to return the uncertainty on the mean of a set of samples
+#
+# method: 'standard error' for s / sqrt(n), or 'bootstrap' for the half width of a bootstrap
+# confidence interval on the mean
+def mean_uncertainty(samples, method='standard error', confidence=0.95, num_bootstrap=1000, rng=None):
+  samples = np.asarray(samples, dtype=np.float64)
+  if len(samples) < 2:
+    return np.inf
+
+  if method == 'standard error':
+    return np.std(samples, ddof=1) / np.sqrt(len(samples))
+  elif method == 'bootstrap':
+    rng = np.random.default_rng(rng)
+    resampled_means = rng.choice(samples, size=(num_bootstrap, len(samples))).mean(axis=1)
+    lower, upper = np.quantile(resampled_means, [(1 - confidence) / 2, (1 + confidence) / 2])
+    return (upper - lower) / 2
+  else:
+    raise ValueError('Unknown uncertainty method ' + str(method))
+
+# Function to decide whether a grid point has enough repeats
+def has_converged(samples, target_error, min_repeats, max_repeats, method='standard error'):
+  if len(samples) >= max_repeats:
+    return True
+  if len(samples) < min_repeats:
+    return False
+  return mean_uncertainty(samples, method) <= target_error
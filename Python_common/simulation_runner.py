@@ -0,0 +1,132 @@
+import asyncio
+import csv
+import json
+import os
+import re
+import subprocess
+import time
+
+# Helpers for running AtomECS examples in isolated scratch directories, so that several
+# simulations can run at once. The examples read their input file and write their output
+# relative to the working directory, so each worker process gets its own directory:
+#
+#   <scratch_root>/worker-<pid>/input.json
+#   <scratch_root>/worker-<pid>/shell_trap_output/pos.txt
+#
+# The scripts are run from the root of the cargo project, which is also where the scratch
+# directories are created by default.
+
+# Runs a compiled AtomECS example directly. The example is built with cargo once, the first time it is
+# needed, and every run after that launches the release binary without cargo's freshness checks.
+#
+# The wall time of each run minus the simulation time the example reports is recorded as the launch
+# overhead. If log_filename is given each run is also appended to it, so runs in worker processes can
+# be compared too.
+class SimulationRunner:
+  def __init__(self, example, manifest_path='Cargo.toml', log_filename=None):
+    self.example = example
+    self.manifest_path = os.path.abspath(manifest_path)
+    self.log_filename = None if log_filename is None else os.path.abspath(log_filename)
+    self.binary = None
+    self.launch_overheads = []
+
+  # Function to build the example and return the path of its compiled binary, only invoking cargo once
+  def resolve_binary(self):
+    if self.binary is not None:
+      return self.binary
+
+    cmd = ['cargo', 'build', '--manifest-path', self.manifest_path, '--example', self.example, '--release', '--message-format=json']
+    build = subprocess.run(cmd, check=True, stdout=subprocess.PIPE, text=True)
+    for line in build.stdout.splitlines():
+      message = json.loads(line)
+      if message.get('reason') == 'compiler-artifact' and message['target']['name'] == self.example and message.get('executable'):
+        self.binary = message['executable']
+
+    if self.binary is None or not os.access(self.binary, os.X_OK):
+      raise RuntimeError('Could not find a compiled binary for example ' + self.example)
+    return self.binary
+
+  # Function to run the example in the given working directory and return its stdout
+  #
+  # supervisor: optional simulation_supervisor.Supervisor which watches the run and can stop it early,
+  #   in which case None is returned
+  def run(self, cwd='.', supervisor=None):
+    binary = self.resolve_binary()
+
+    start = time.perf_counter()
+    if supervisor is None:
+      stdout = subprocess.run([binary], cwd=cwd, check=True, stdout=subprocess.PIPE, text=True).stdout
+    else:
+      returncode, stdout, pruned = asyncio.run(supervisor.run([binary], cwd))
+      if pruned:
+        return None
+      if returncode != 0:
+        raise subprocess.CalledProcessError(returncode, [binary], stdout)
+    wall_ms = (time.perf_counter() - start) * 1e3
+
+    match = re.search(r'Simulation completed in (\d+) ms', stdout)
+    if match:
+      sim_ms = int(match.group(1))
+      self.launch_overheads.append(wall_ms - sim_ms)
+      if self.log_filename is not None:
+        with open(self.log_filename, 'a') as f:
+          csv.writer(f).writerow([self.example, os.getpid(), round(wall_ms, 1), sim_ms, round(wall_ms - sim_ms, 1)])
+
+    return stdout
+
+  # Function to return the number of runs and the mean launch overhead in ms
+  def overhead_summary(self):
+    if len(self.launch_overheads) == 0:
+      return 0, float('nan')
+    return len(self.launch_overheads), sum(self.launch_overheads) / len(self.launch_overheads)
+
+# Function to return one entry of the output plan an example reads from the "output" list of its input
+# file, which asks for a component ("position" or "velocity") to be written to filename every interval
+# steps from start to end (or the end of the run), for the atoms whose id is a multiple of atom_stride
+def output_plan(component, filename, interval, start=0, end=None, atom_stride=1):
+  plan = {'component': component, 'file': filename, 'start': int(start), 'interval': int(interval), 'atom_stride': int(atom_stride)}
+  if end is not None:
+    plan['end'] = int(end)
+  return plan
+
+# Function to return this process's sandbox directory, creating it and its output folders on first use
+def worker_sandbox(scratch_root='sandboxes', output_dirs=('shell_trap_output',)):
+  sandbox = os.path.join(os.path.abspath(scratch_root), 'worker-' + str(os.getpid()))
+  for output_dir in output_dirs:
+    os.makedirs(os.path.join(sandbox, output_dir), exist_ok=True)
+  return sandbox
+
+# Function to run a simulation with the given parameters in this process's sandbox
+#
+# runner: SimulationRunner for the example to run
+# params: dict written as json to input_filename inside the sandbox
+# output_dirs: folders the example writes its output into, created inside the sandbox
+# supervisor: optional Supervisor which can stop the run early (see SimulationRunner.run)
+#
+# Returns the sandbox directory, which holds the output of the run until the next run in this process,
+# or None if the supervisor stopped the run.
+def run_simulation(runner, params, input_filename='input.json', output_dirs=('shell_trap_output',), scratch_root='sandboxes', supervisor=None):
+  sandbox = worker_sandbox(scratch_root, output_dirs)
+  with open(os.path.join(sandbox, input_filename), 'w') as f:
+    json.dump(params, f)
+    f.flush()
+
+  if runner.run(cwd=sandbox, supervisor=supervisor) is None:
+    return None
+  return sandbox
+
+# Function to run a batch of parameter sets in a single simulation process, in this process's sandbox
+#
+# The parameter sets are written to input_filename as {"configurations": [...]}, which the example
+# simulates one after the other, writing configuration i to <output_dir>/config_<i>/. Process startup
+# and the build check are paid once for the whole batch.
+#
+# Returns the output directory of each configuration, in the order of params_list.
+def run_simulation_batch(runner, params_list, input_filename='input.json', output_dir='shell_trap_output', scratch_root='sandboxes'):
+  sandbox = worker_sandbox(scratch_root, (output_dir,))
+  with open(os.path.join(sandbox, input_filename), 'w') as f:
+    json.dump({'configurations': params_list}, f)
+    f.flush()
+
+  runner.run(cwd=sandbox)
+  return [os.path.join(sandbox, output_dir, 'config_' + str(i)) for i in range(len(params_list))]
@@ -0,0 +1,168 @@
+import asyncio
+import json
+import os
+import numpy as np
+
+from atomecs_output import parse_header, parse_records
+
+# Supervision of a running simulation, so hopeless optimiser candidates can be stopped early.
+#
+# The example is asked (through its output plan) to write sparse monitor output, e.g. a subset of the
+# atoms every few hundred steps. While the simulation runs, the supervisor tails those files, keeps
+# cheap running statistics (remaining atom count, spread, mean |v|^2) and calls a pruning rule after
+# each poll. If the rule returns True the simulation is killed, and the objective can return a penalty
+# instead of waiting for the run to finish.
+
+# Incremental reader of an output file which is still being written, returning only complete frames
+class FrameTail:
+  def __init__(self, path):
+    self.path = path
+    self.offset = 0
+    self.buffer = b''
+
+  # Function to return the step, atom ids and values of every frame completed since the last call
+  def read_frames(self):
+    frames = []
+    if not os.path.exists(self.path):
+      return frames
+
+    with open(self.path, 'rb') as f:
+      f.seek(self.offset)
+      data = f.read()
+    self.offset += len(data)
+    self.buffer += data
+
+    while True:
+      header_end = self.buffer.find(b'\n')
+      if header_end == -1:
+        return frames
+      step, count = parse_header(self.buffer[:header_end])
+
+      # Wait for the rest of the frame if not all of its records have been written yet
+      end = header_end + 1
+      for _ in range(count):
+        end = self.buffer.find(b'\n', end) + 1
+        if end == 0:
+          return frames
+
+      atom_ids, values = parse_records(self.buffer[header_end + 1:end])
+      frames.append((step, atom_ids, values))
+      self.buffer = self.buffer[end:]
+
+# Running statistics of the monitor output of a simulation
+#
+# atom_stride: the stride of the monitored atom subset, used to scale counts back up to the whole cloud
+class MonitorStatistics:
+  def __init__(self, atom_stride=1):
+    self.atom_stride = atom_stride
+    self.steps = []
+    self.atom_counts = []
+    self.spreads = []
+    self.vel_steps = []
+    self.mean_vel_squared = []
+    self.positions = {}
+    self.velocities = {}
+
+  def add_frame(self, component, step, atom_ids, values):
+    if component == 'position':
+      self.steps.append(step)
+      self.atom_counts.append(len(atom_ids) * self.atom_stride)
+      # RMS distance of the atoms from the centre of the cloud
+      spread = np.sqrt(np.mean(np.sum((values - values.mean(axis=0))**2, axis=1))) if len(values) > 0 else np.nan
+      self.spreads.append(spread)
+      self.positions[step] = values
+    elif component == 'velocity':
+      self.vel_steps.append(step)
+      self.mean_vel_squared.append(np.mean(np.sum(values**2, axis=1)) if len(values) > 0 else np.nan)
+      self.velocities[step] = values
+
+    # Only the most recent frames are kept
+    for frames in (self.positions, self.velocities):
+      for old_step in sorted(frames)[:-2]:
+        del frames[old_step]
+
+  # Function to return the latest step with both a position and a velocity frame, and those frames
+  def latest_frame(self):
+    common_steps = set(self.positions) & set(self.velocities)
+    if len(common_steps) == 0:
+      return None, None, None
+    step = max(common_steps)
+    return step, self.positions[step], self.velocities[step]
+
+  # Function to return the latest step with a position frame and the estimated number of atoms left at it
+  def latest_atom_count(self):
+    if len(self.steps) == 0:
+      return None, None
+    return self.steps[-1], self.atom_counts[-1]
+
+# Runs a simulation under asyncio, tailing its monitor files and killing it once prune(statistics) is True
+#
+# monitors: dict of monitor file paths relative to the working directory, keyed by component
+#   ('position' or 'velocity')
+# prune: pruning rule, called with the MonitorStatistics after every poll
+class Supervisor:
+  def __init__(self, monitors, prune, atom_stride=1, poll_interval=0.2):
+    self.monitors = monitors
+    self.prune = prune
+    self.atom_stride = atom_stride
+    self.poll_interval = poll_interval
+    self.statistics = None
+
+  # Function to run cmd in cwd, returning its return code, stdout and whether it was pruned
+  async def run(self, cmd, cwd):
+    # Monitor files from a previous run in the same directory would otherwise be read before they're truncated
+    tails = {}
+    for component, filename in self.monitors.items():
+      path = os.path.join(cwd, filename)
+      if os.path.exists(path):
+        os.remove(path)
+      tails[component] = FrameTail(path)
+    self.statistics = MonitorStatistics(self.atom_stride)
+
+    process = await asyncio.create_subprocess_exec(*cmd, cwd=cwd, stdout=asyncio.subprocess.PIPE)
+    stdout = asyncio.create_task(process.stdout.read())
+    pruned = False
+    while True:
+      try:
+        await asyncio.wait_for(process.wait(), self.poll_interval)
+        finished = True
+      except asyncio.TimeoutError:
+        finished = False
+
+      for component, tail in tails.items():
+        for step, atom_ids, values in tail.read_frames():
+          self.statistics.add_frame(component, step, atom_ids, values)
+
+      if finished:
+        break
+      if self.prune(self.statistics):
+        process.kill()
+        await process.wait()
+        pruned = True
+        break
+
+    output = await stdout
+    return process.returncode, output.decode(), pruned
+
+# Function to atomically save the best objective value found so far, so supervisors in worker processes can read it
+def save_best(filename, value):
+  tmp_filename = filename + '.tmp'
+  with open(tmp_filename, 'w') as f:
+    json.dump({'best': float(value)}, f)
+  os.replace(tmp_filename, filename)
+
+# Function to load the best objective value found so far, or None if there isn't one yet
+def load_best(filename):
+  if not os.path.exists(filename):
+    return None
+  with open(filename, 'r') as f:
+    return json.load(f)['best']
+
+# Function to start the best objective value of a new optimiser run, so it is only pruned against its own results
+#
+# value: best value of a resumed run, e.g. from its checkpointed population, or None to start without one
+def reset_best(filename, value=None):
+  if value is not None and np.isfinite(value):
+    save_best(filename, value)
+  elif os.path.exists(filename):
+    os.remove(filename)
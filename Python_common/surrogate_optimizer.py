@@ -0,0 +1,209 @@
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from scipy.linalg import cho_factor, cho_solve
+from scipy.optimize import OptimizeResult, differential_evolution, minimize
+from scipy.stats import norm, qmc
+
+# Gaussian process surrogate optimiser for expensive objectives such as get_PSD and
+# get_thermalisation_temp. It minimises, like differential_evolution, over the same bounds:
+#
+#   1. evaluate a Latin hypercube of initial points
+#   2. fit a Gaussian process (Matern 5/2 kernel) to every evaluation so far
+#   3. choose a batch of points by expected improvement, using the "kriging believer" heuristic
+#      (each chosen point is added to the model at its predicted value before choosing the next)
+#   4. evaluate the batch in parallel on a worker pool and repeat from 2
+#
+# Inputs are scaled to the unit cube and outputs standardised before fitting.
+
+# Function to evaluate the Matern 5/2 kernel between two sets of unit cube points
+def matern52(XA, XB, length_scales, signal_var):
+  d = np.sqrt(np.sum(((XA[:, None, :] - XB[None, :, :]) / length_scales)**2, axis=2))
+  return signal_var * (1 + np.sqrt(5) * d + (5/3) * d**2) * np.exp(-np.sqrt(5) * d)
+
+# Gaussian process regression model with hyperparameters fitted by maximum marginal likelihood
+class GaussianProcess:
+  def __init__(self):
+    self.log_params = None
+
+  # Function to return the negative log marginal likelihood for log hyperparameters
+  # (log length scales, log signal variance, log noise variance)
+  def negative_log_likelihood(self, log_params, X, z):
+    length_scales = np.exp(log_params[:-2])
+    K = matern52(X, X, length_scales, np.exp(log_params[-2])) + (np.exp(log_params[-1]) + 1e-10) * np.eye(len(X))
+    try:
+      factor = cho_factor(K, lower=True)
+    except np.linalg.LinAlgError:
+      return 1e25
+    alpha = cho_solve(factor, z)
+    return 0.5 * z @ alpha + np.sum(np.log(np.diag(factor[0]))) + 0.5 * len(X) * np.log(2 * np.pi)
+
+  # Function to fit the model to unit cube points X and values y, optionally refitting the hyperparameters
+  def fit(self, X, y, optimize=True, rng=None):
+    self.X = X
+    self.y = y
+    self.y_mean = np.mean(y)
+    self.y_std = np.std(y) if np.std(y) > 0 else 1.0
+    z = (y - self.y_mean) / self.y_std
+
+    if optimize or self.log_params is None:
+      rng = np.random.default_rng(rng)
+      dim = X.shape[1]
+      bounds = [(np.log(1e-2), np.log(1e1))] * dim + [(np.log(1e-2), np.log(1e2)), (np.log(1e-8), np.log(1.0))]
+      starts = [np.r_[np.full(dim, np.log(0.3)), 0.0, np.log(1e-3)]]
+      starts += [np.array([rng.uniform(low, high) for low, high in bounds]) for _ in range(4)]
+      if self.log_params is not None:
+        starts.append(self.log_params)
+
+      best = None
+      for start in starts:
+        result = minimize(self.negative_log_likelihood, start, args=(X, z), method='L-BFGS-B', bounds=bounds)
+        if best is None or result.fun < best.fun:
+          best = result
+      self.log_params = best.x
+
+    length_scales = np.exp(self.log_params[:-2])
+    K = matern52(X, X, length_scales, np.exp(self.log_params[-2])) + (np.exp(self.log_params[-1]) + 1e-10) * np.eye(len(X))
+    self.factor = cho_factor(K, lower=True)
+    self.alpha = cho_solve(self.factor, z)
+    return self
+
+  # Function to return the predicted mean and standard deviation at unit cube points
+  def predict(self, Xs):
+    length_scales = np.exp(self.log_params[:-2])
+    signal_var = np.exp(self.log_params[-2])
+    Ks = matern52(Xs, self.X, length_scales, signal_var)
+    mean = Ks @ self.alpha
+    v = cho_solve(self.factor, Ks.T)
+    var = np.maximum(signal_var - np.sum(Ks * v.T, axis=1), 1e-12)
+    return self.y_mean + self.y_std * mean, self.y_std * np.sqrt(var)
+
+# Function to return the expected improvement over the best value found so far, for minimisation
+def expected_improvement(gp, Xs, y_best, xi=0.01):
+  mean, std = gp.predict(Xs)
+  improvement = y_best - mean - xi * gp.y_std
+  z = improvement / std
+  return improvement * norm.cdf(z) + std * norm.pdf(z)
+
+# Function to choose the unit cube point with the highest expected improvement
+def maximise_acquisition(gp, y_best, dim, rng, num_candidates=2000, num_polish=5):
+  candidates = rng.random((num_candidates, dim))
+  # Also search close to the best points evaluated so far
+  best_points = gp.X[np.argsort(gp.y)[:5]]
+  local = np.clip(best_points[rng.integers(len(best_points), size=num_candidates // 4)] + rng.normal(0, 0.05, (num_candidates // 4, dim)), 0, 1)
+  candidates = np.vstack([candidates, local])
+
+  ei = expected_improvement(gp, candidates, y_best)
+  best_x = candidates[np.argmax(ei)]
+  best_ei = np.max(ei)
+  for start in candidates[np.argsort(ei)[-num_polish:]]:
+    result = minimize(lambda x: -expected_improvement(gp, x[None, :], y_best)[0], start, method='L-BFGS-B', bounds=[(0, 1)] * dim)
+    if -result.fun > best_ei:
+      best_x, best_ei = result.x, -result.fun
+  return best_x
+
+# Function to minimise an expensive objective with a Gaussian process surrogate and batched expected improvement
+#
+# func, bounds: as for differential_evolution
+# maxiter: number of batches evaluated after the initial design
+# batch_size: points evaluated in parallel per iteration, normally the number of workers
+# n_initial: size of the initial Latin hypercube design, defaults to max(2 * dim + 1, batch_size)
+# callback: called with an intermediate OptimizeResult (x, fun, nfev, nit) after each batch, like the
+#   differential_evolution callbacks in the optimiser scripts, and stops early if it returns True
+# target: optional objective value at which to stop
+def surrogate_minimize(func, bounds, maxiter=50, batch_size=8, n_initial=None, workers=1, callback=None, rng=None, target=None):
+  rng = np.random.default_rng(rng)
+  bounds = np.asarray(bounds, dtype=np.float64)
+  dim = len(bounds)
+  lower, upper = bounds[:, 0], bounds[:, 1]
+  n_initial = max(2 * dim + 1, batch_size) if n_initial is None else n_initial
+
+  X = qmc.LatinHypercube(d=dim, seed=rng).random(n_initial)
+  y = np.empty(0)
+
+  executor = ProcessPoolExecutor(max_workers=workers) if workers > 1 else None
+  evaluate = executor.map if executor is not None else map
+  try:
+    y = np.array(list(evaluate(func, lower + X * (upper - lower))), dtype=np.float64)
+    gp = GaussianProcess()
+
+    for nit in range(1, maxiter + 1):
+      if target is not None and np.min(y) <= target:
+        break
+
+      # Choose a batch, believing the model's prediction at each chosen point while choosing the next
+      gp.fit(X, y, optimize=True, rng=rng)
+      batch = []
+      X_believed, y_believed = X, y
+      for _ in range(batch_size):
+        x_next = maximise_acquisition(gp, np.min(y), dim, rng)
+        batch.append(x_next)
+        X_believed = np.vstack([X_believed, x_next])
+        y_believed = np.append(y_believed, gp.predict(x_next[None, :])[0])
+        gp.fit(X_believed, y_believed, optimize=False)
+
+      batch = np.array(batch)
+      y_batch = np.array(list(evaluate(func, lower + batch * (upper - lower))), dtype=np.float64)
+      X = np.vstack([X, batch])
+      y = np.append(y, y_batch)
+
+      best = np.argmin(y)
+      result = OptimizeResult(x=lower + X[best] * (upper - lower), fun=y[best], nfev=len(y), nit=nit)
+      if callback is not None and callback(result):
+        break
+  finally:
+    if executor is not None:
+      executor.shutdown()
+
+  best = np.argmin(y)
+  return OptimizeResult(
+    x=lower + X[best] * (upper - lower),
+    fun=y[best],
+    nfev=len(y),
+    n_initial=n_initial,
+    evaluated_x=lower + X * (upper - lower),
+    evaluated_fun=y
+  )
+
+# Function to compare how many objective evaluations differential_evolution and the surrogate
+# optimiser need to reach a target value, for the same objective and bounds
+#
+# Returns a dict of evaluations to target (None if the target wasn't reached) for each optimiser.
+def benchmark(func, bounds, target, max_evaluations, batch_size=8, workers=1, de_kwargs=None, rng=None):
+  de_kwargs = {'popsize': 15, 'mutation': 0.7} if de_kwargs is None else de_kwargs
+  evaluations_to_target = {'differential evolution': None, 'surrogate': None}
+
+  def de_callback(intermediate_result):
+    if intermediate_result.fun <= target:
+      evaluations_to_target['differential evolution'] = intermediate_result.nfev
+      return True
+    return intermediate_result.nfev >= max_evaluations
+
+  differential_evolution(
+    func,
+    bounds,
+    callback=de_callback,
+    polish=False,
+    updating='deferred',
+    workers=workers,
+    rng=rng,
+    **de_kwargs
+  )
+
+  res = surrogate_minimize(
+    func,
+    bounds,
+    maxiter=max(max_evaluations // batch_size, 1),
+    batch_size=batch_size,
+    workers=workers,
+    rng=rng,
+    target=target
+  )
+  if res.fun <= target:
+    # Count whole batches, as differential evolution is counted in whole generations
+    reached = np.flatnonzero(res.evaluated_fun <= target)[0]
+    num_batches = int(np.ceil(max(reached + 1 - res.n_initial, 0) / batch_size))
+    evaluations_to_target['surrogate'] = res.n_initial + num_batches * batch_size
+
+  for optimiser, evaluations in evaluations_to_target.items():
+    print(optimiser + ': ' + ('target not reached' if evaluations is None else str(evaluations) + ' evaluations to target'))
+  return evaluations_to_target
@@ -0,0 +1,252 @@
+import csv
+import json
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, as_completed, wait
+
+import numpy as np
+
+from atomecs_output import read_atom_count
+from results_store import append_results, parse_number_list
+from sequential_sampling import has_converged
+from simulation_runner import run_simulation
+
+# Resumable, parallel scheduler for the cell MOT capture fraction sweeps.
+#
+# The (offset, detuning, repeat) grid is expanded into one job per simulation, each with a stable
+# string key built from fixed precision formatting, so finished work is never matched by float
+# equality. Every finished job is appended as one json line to a ledger file. Restarting a sweep
+# reads the ledger and only runs the jobs whose keys are missing.
+
+# Function to return the stable key of a sweep job
+def job_key(offset_delta, detuning, number_of_steps, repeat):
+  return 'offset=%.6f|detuning=%.3f|steps=%d|repeat=%d' % (offset_delta, detuning, number_of_steps, repeat)
+
+# Function to return the job for one repeat at one grid point
+def make_job(offset_delta, detuning, number_of_steps, repeat):
+  return {
+    'key': job_key(offset_delta, detuning, number_of_steps, repeat),
+    'offset delta': float(offset_delta),
+    'detuning': float(detuning),
+    'number of steps': int(number_of_steps),
+    'repeat': repeat,
+  }
+
+# Function to expand a sweep grid into a list of jobs
+def expand_jobs(offset_deltas, detunings, number_of_steps, number_of_sims):
+  jobs = []
+  for offset_delta in offset_deltas:
+    for detuning in detunings:
+      for repeat in range(number_of_sims):
+        jobs.append(make_job(offset_delta, detuning, number_of_steps, repeat))
+  return jobs
+
+# Function to read a ledger into a dict of finished jobs keyed by job key
+def load_ledger(ledger_filename):
+  finished = {}
+  if not os.path.exists(ledger_filename):
+    return finished
+
+  with open(ledger_filename, 'r') as f:
+    for line in f:
+      # A crash can leave a partial last line, which is simply rerun
+      try:
+        record = json.loads(line)
+      except ValueError:
+        continue
+      finished[record['key']] = record
+  return finished
+
+# Function to append one finished job to the ledger with a single write, so a record is either complete or absent
+def append_to_ledger(ledger_filename, record):
+  fd = os.open(ledger_filename, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+  try:
+    os.write(fd, (json.dumps(record) + '\n').encode())
+    os.fsync(fd)
+  finally:
+    os.close(fd)
+
+# Function to add the results of an old style sweep csv, with a capture fraction array per row, to the ledger
+#
+# The new ledger is written to a temporary file, synced once and moved into place, so an interrupted
+# import leaves the ledger as it was rather than holding part of the csv.
+def import_csv_into_ledger(csv_filename, ledger_filename):
+  finished = load_ledger(ledger_filename)
+  tmp_filename = ledger_filename + '.import'
+  with open(tmp_filename, 'w') as out:
+    for record in finished.values():
+      out.write(json.dumps(record) + '\n')
+
+    with open(csv_filename, 'r') as f:
+      for line in csv.DictReader(f):
+        for repeat, capture_fraction in enumerate(parse_number_list(line['capture fraction array'])):
+          key = job_key(float(line['offset delta']), float(line['detuning']), int(line['number of steps']), repeat)
+          if key not in finished:
+            out.write(json.dumps({
+              'key': key,
+              'offset delta': float(line['offset delta']),
+              'detuning': float(line['detuning']),
+              'number of steps': int(line['number of steps']),
+              'repeat': repeat,
+              'capture fraction': float(capture_fraction),
+            }) + '\n')
+    out.flush()
+    os.fsync(out.fileno())
+  os.replace(tmp_filename, ledger_filename)
+
+# Function to return the capture fraction at a given step from a cell MOT position output file
+def calculate_capture_fraction(filename, number_of_steps, number_of_atoms):
+  return read_atom_count(filename, number_of_steps) / number_of_atoms
+
+# Function to run a single sweep job in this worker's sandbox and return its ledger record
+def run_job(job, runner, number_of_atoms):
+  params = {
+    "offset_delta": job['offset delta'],
+    "detuning": -job['detuning'],
+    "number_of_steps": job['number of steps']
+  }
+  sandbox = run_simulation(runner, params, input_filename='offsets.json', output_dirs=('cell_mot_output',))
+
+  record = dict(job)
+  record['capture fraction'] = calculate_capture_fraction(
+    os.path.join(sandbox, 'cell_mot_output/pos.txt'),
+    job['number of steps'],
+    number_of_atoms
+  )
+  return record
+
+# Function to return the ledger record of a finished job future, or None after printing why the job failed
+#
+# A failed job is left out of the ledger, so it is rerun when the sweep is restarted.
+def job_result(future, job):
+  try:
+    return future.result()
+  except Exception as e:
+    print('Job ' + job['key'] + ' failed: ' + repr(e))
+    return None
+
+# Function to run every unfinished job on a process pool, appending each result to the ledger as it completes
+def run_sweep(jobs, runner, ledger_filename, number_of_atoms=1000, num_workers=None, report_every=100):
+  finished = load_ledger(ledger_filename)
+  pending = [job for job in jobs if job['key'] not in finished]
+  print('Skipping ' + str(len(jobs) - len(pending)) + ' finished jobs, running ' + str(len(pending)))
+  if len(pending) == 0:
+    return finished
+
+  runner.resolve_binary()
+  start = time.perf_counter()
+  executor = ProcessPoolExecutor(max_workers=num_workers)
+  try:
+    futures = {executor.submit(run_job, job, runner, number_of_atoms): job for job in pending}
+    for num_done, future in enumerate(as_completed(futures), start=1):
+      record = job_result(future, futures[future])
+      if record is not None:
+        append_to_ledger(ledger_filename, record)
+        finished[record['key']] = record
+
+      if num_done % report_every == 0 or num_done == len(pending):
+        sims_per_hour = num_done / (time.perf_counter() - start) * 3600
+        print(str(num_done) + '/' + str(len(pending)) + ' sims done, ' + str(round(sims_per_hour)) + ' sims per hour')
+  finally:
+    # On an error or interrupt, don't wait for the queued jobs whose results would be thrown away
+    executor.shutdown(cancel_futures=True)
+
+  return finished
+
+# Function to return the finished capture fractions of one grid point, in repeat order
+def point_capture_fractions(finished, offset_delta, detuning, number_of_steps, max_sims):
+  keys = [job_key(offset_delta, detuning, number_of_steps, repeat) for repeat in range(max_sims)]
+  return [finished[key]['capture fraction'] for key in keys if key in finished]
+
+# Function to run a sweep with an adaptive number of repeats per grid point
+#
+# Each point first gets min_sims repeats, then further batches of batch_sims until the uncertainty
+# on its mean capture fraction is below target_error (see sequential_sampling) or it reaches
+# max_sims. Repeats finished before a restart are read from the ledger and count towards the rule.
+def run_adaptive_sweep(offset_deltas, detunings, number_of_steps, runner, ledger_filename, min_sims, max_sims, target_error, method='standard error', batch_sims=5, number_of_atoms=1000, num_workers=None, report_every=100):
+  finished = load_ledger(ledger_filename)
+  points = [(offset_delta, detuning) for offset_delta in offset_deltas for detuning in detunings]
+
+  runner.resolve_binary()
+  start = time.perf_counter()
+  num_done = 0
+  executor = ProcessPoolExecutor(max_workers=num_workers)
+  try:
+    running = {}
+    outstanding = {point: 0 for point in points}
+    # Keys of the jobs which failed, which aren't retried until the sweep is restarted
+    failed = set()
+
+    # Function to submit the next batch of repeats for a grid point, unless it has converged
+    def submit_batch(point):
+      capture_fractions = point_capture_fractions(finished, point[0], point[1], number_of_steps, max_sims)
+      if has_converged(capture_fractions, target_error, min_sims, max_sims, method):
+        return
+
+      batch_size = max(min_sims - len(capture_fractions), batch_sims)
+      keys = [job_key(point[0], point[1], number_of_steps, repeat) for repeat in range(max_sims)]
+      missing = [repeat for repeat, key in enumerate(keys) if key not in finished and key not in failed]
+      for repeat in missing[:batch_size]:
+        job = make_job(point[0], point[1], number_of_steps, repeat)
+        running[executor.submit(run_job, job, runner, number_of_atoms)] = (point, job)
+        outstanding[point] += 1
+
+    for point in points:
+      submit_batch(point)
+
+    while len(running) > 0:
+      done, not_done = wait(running, return_when=FIRST_COMPLETED)
+      for future in done:
+        point, job = running.pop(future)
+        record = job_result(future, job)
+        if record is None:
+          failed.add(job['key'])
+        else:
+          append_to_ledger(ledger_filename, record)
+          finished[record['key']] = record
+        num_done += 1
+
+        # Only decide on more repeats once the whole batch for this point is in
+        outstanding[point] -= 1
+        if outstanding[point] == 0:
+          submit_batch(point)
+
+        if num_done % report_every == 0:
+          sims_per_hour = num_done / (time.perf_counter() - start) * 3600
+          print(str(num_done) + ' sims done, ' + str(len(running)) + ' running, ' + str(round(sims_per_hour)) + ' sims per hour')
+  finally:
+    executor.shutdown(cancel_futures=True)
+
+  for point in points:
+    num_sims = len(point_capture_fractions(finished, point[0], point[1], number_of_steps, max_sims))
+    print('Offset ' + str(point[0]) + ' and detuning ' + str(point[1]) + ' used ' + str(num_sims) + ' sims')
+
+  return finished
+
+# Function to write the finished jobs of a sweep grid as an old style csv, with a capture fraction array per row
+# and the number of repeats each grid point used
+def write_sweep_csv(csv_filename, finished, offset_deltas, detunings, number_of_steps, max_sims):
+  header = ['detuning', 'offset delta', 'number of steps', 'capture fraction array', 'number of sims']
+  with open(csv_filename, 'w') as f:
+    writer = csv.writer(f)
+    writer.writerow(header)
+    for offset_delta in offset_deltas:
+      for detuning in detunings:
+        capture_fractions = point_capture_fractions(finished, offset_delta, detuning, number_of_steps, max_sims)
+        if len(capture_fractions) > 0:
+          writer.writerow([detuning, offset_delta, number_of_steps, capture_fractions, len(capture_fractions)])
+
+# Function to write the finished jobs of a sweep grid to a new results store (see results_store), replacing
+# any previous store once it is complete
+def write_sweep_store(store_filename, finished, offset_deltas, detunings, number_of_steps, max_sims):
+  tmp_filename = store_filename + '.partial'
+  if os.path.exists(tmp_filename):
+    os.remove(tmp_filename)
+
+  for offset_delta in offset_deltas:
+    for detuning in detunings:
+      capture_fractions = point_capture_fractions(finished, offset_delta, detuning, number_of_steps, max_sims)
+      if len(capture_fractions) > 0:
+        append_results(tmp_filename, offset_delta, detuning, number_of_steps, np.arange(len(capture_fractions)), capture_fractions)
+  if os.path.exists(tmp_filename):
+    os.replace(tmp_filename, store_filename)
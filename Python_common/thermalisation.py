@@ -0,0 +1,76 @@
+import numpy as np
+
+from atomecs_output import iter_frames, parse_records
+from compressed_output import open_output
+
+# Mass of a rubidium-87 atom [kg] and the Boltzmann constant [J/K]
+rb87_mass = 87 * 1.66054e-27
+boltzmann_constant = 1.38065e-23
+
+# Running count, mean and sum of squared deviations of a stream of values. Each frame is merged
+# in as one batch using the parallel form of Welford's algorithm, so only three numbers are kept.
+class MomentAccumulator:
+  def __init__(self):
+    self.count = 0
+    self.mean = 0.0
+    self.m2 = 0.0
+
+  def add(self, values):
+    values = values[~np.isnan(values)]
+    if len(values) == 0:
+      return
+
+    batch_mean = np.mean(values)
+    batch_m2 = np.sum((values - batch_mean)**2)
+    delta = batch_mean - self.mean
+    total = self.count + len(values)
+
+    self.mean += delta * len(values) / total
+    self.m2 += batch_m2 + delta**2 * self.count * len(values) / total
+    self.count = total
+
+  def variance(self):
+    return self.m2 / self.count if self.count > 0 else np.nan
+
+# Function to convert a mean |v|^2 into the equivalent temperature, T = (2/3) <KE> / k_B
+def vel_squared_to_temperature(mean_vel_squared, mass=rb87_mass):
+  average_KE = 0.5 * mass * mean_vel_squared
+  return ((2/3) * average_KE) / boltzmann_constant
+
+# Reducer for a stream of velocity frames (see output_stream), keeping the temperature of every frame
+# and the moments of |v|^2 over every atom in the steps window_start <= step <= window_end
+class ThermalisationReducer:
+  def __init__(self, window_start, window_end=None, mass=rb87_mass):
+    self.window_start = window_start
+    self.window_end = window_end
+    self.mass = mass
+    self.window = MomentAccumulator()
+    self.steps = []
+    self.mean_vel_squared = []
+
+  def wants(self, step):
+    return True
+
+  def add_frame(self, step, atom_ids, velocities):
+    vel_squared = np.sum(velocities**2, axis=1)
+    self.steps.append(step)
+    self.mean_vel_squared.append(np.mean(vel_squared) if len(vel_squared) > 0 else np.nan)
+    if step >= self.window_start and (self.window_end is None or step <= self.window_end):
+      self.window.add(vel_squared)
+
+  # Function to return the window temperature, and the step numbers and temperature of every frame
+  def result(self):
+    window_temp = vel_squared_to_temperature(self.window.mean if self.window.count > 0 else np.nan, self.mass)
+    return window_temp, np.array(self.steps, dtype=np.int64), vel_squared_to_temperature(np.array(self.mean_vel_squared), self.mass)
+
+# Function to stream a velocity output file frame by frame in O(atoms) memory
+#
+# Returns the temperature averaged over every atom in the steps window_start <= step <= window_end,
+# plus the step numbers and temperature of every frame in the file.
+def thermalisation_temperature(vel_filename, window_start, window_end=None, mass=rb87_mass):
+  reducer = ThermalisationReducer(window_start, window_end, mass)
+  with open_output(vel_filename) as f:
+    for step, count, records in iter_frames(f):
+      atom_ids, velocities = parse_records(records)
+      reducer.add_frame(step, atom_ids, velocities)
+  return reducer.result()
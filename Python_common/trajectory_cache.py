@@ -0,0 +1,118 @@
+import os
+import numpy as np
+
+from atomecs_output import iter_frames, parse_records
+from compressed_output import open_output, resolve_output
+
+# Atom-major binary cache of AtomECS Text output, for extracting the trajectories of a few atoms.
+#
+# The step-major cache in output_cache stores each frame contiguously, so one atom's trajectory is
+# spread over every page of it. Here a text file such as `pos.txt` is instead converted once into
+#
+#   pos.txt.atoms.npy       (atoms, steps, 3) float32 block, one contiguous row per atom
+#   pos.txt.atoms.meta.npz  step numbers, atom ids and the size/mtime of the source file
+#
+# keyed by the atom id written in each record, over every atom appearing in any frame (e.g. atoms
+# emitted by a source part way through a cell MOT run). Reading an atom's whole trajectory is then a
+# single contiguous read. The cache is rebuilt whenever the source file's size or mtime changes.
+# A compressed output file (see compressed_output) is cached under its own name, e.g. pos.txt.zst.atoms.npy.
+
+# Layout of the records of the intermediate file written while parsing, in frame order
+record_dtype = np.dtype([('frame', '<i8'), ('id', '<i8'), ('value', '<f4', (3,))])
+
+# Function to return the paths of the value block and header of the atom-major cache of an output file
+def trajectory_cache_paths(filename):
+  return str(filename) + '.atoms.npy', str(filename) + '.atoms.meta.npz'
+
+# Function to check whether the atom-major cache of an output file exists and was built from its current contents
+def trajectory_cache_is_valid(filename):
+  values_path, meta_path = trajectory_cache_paths(filename)
+  if not (os.path.exists(values_path) and os.path.exists(meta_path)):
+    return False
+
+  stat = os.stat(filename)
+  with np.load(meta_path) as meta:
+    return meta['size'] == stat.st_size and meta['mtime_ns'] == stat.st_mtime_ns
+
+# Function to convert an output file into the atom-major cache
+#
+# The text is parsed once, frame by frame, into an intermediate file of (frame, atom id, value) records.
+# The records are then transposed into the atom-major block step_block frames at a time, so each atom's
+# row is written in contiguous runs and memory stays bounded for any run length.
+def convert_trajectories(filename, dtype=np.float32, step_block=256):
+  filename = resolve_output(filename)
+  values_path, meta_path = trajectory_cache_paths(filename)
+  stat = os.stat(filename)
+  records_path = values_path + '.records.tmp'
+
+  steps = []
+  frame_counts = []
+  atom_ids = np.empty(0, dtype=np.int64)
+  with open_output(filename) as f, open(records_path, 'wb') as out:
+    for frame, (step, count, records) in enumerate(iter_frames(f)):
+      frame_ids, frame_values = parse_records(records, np.float32)
+      frame_records = np.empty(len(frame_ids), dtype=record_dtype)
+      frame_records['frame'] = frame
+      frame_records['id'] = frame_ids
+      frame_records['value'] = frame_values
+      out.write(frame_records.tobytes())
+
+      steps.append(step)
+      frame_counts.append(len(frame_ids))
+      atom_ids = np.union1d(atom_ids, frame_ids)
+
+  # Write to temporary names and move into place at the end, so an interrupted conversion is never loaded
+  values_tmp = values_path + '.tmp'
+  values = np.lib.format.open_memmap(values_tmp, mode='w+', dtype=dtype, shape=(len(atom_ids), len(steps), 3))
+  records = np.memmap(records_path, dtype=record_dtype, mode='r') if sum(frame_counts) > 0 else np.empty(0, dtype=record_dtype)
+  frame_offsets = np.concatenate([[0], np.cumsum(frame_counts, dtype=np.int64)])
+  for start in range(0, len(steps), step_block):
+    end = min(start + step_block, len(steps))
+    block_records = records[frame_offsets[start]:frame_offsets[end]]
+
+    # Atoms missing from a frame (e.g. lost from the simulation volume, or not yet emitted) are left as NaN
+    block = np.full((len(atom_ids), end - start, 3), np.nan, dtype=dtype)
+    block[np.searchsorted(atom_ids, block_records['id']), block_records['frame'] - start] = block_records['value']
+    values[:, start:end] = block
+  values.flush()
+  del values
+  del records
+  os.remove(records_path)
+
+  meta_tmp = meta_path + '.tmp'
+  with open(meta_tmp, 'wb') as f:
+    np.savez(f, steps=np.array(steps, dtype=np.int64), atom_ids=atom_ids, size=stat.st_size, mtime_ns=stat.st_mtime_ns)
+
+  os.replace(values_tmp, values_path)
+  os.replace(meta_tmp, meta_path)
+
+# Function to load the trajectories of atoms through the atom-major cache, converting it first if needed
+#
+# Takes the same atoms selection as load_output and read_output, and returns the step numbers, the
+# (sorted) atom ids and a (steps, atoms, 3) view of their values, so it can replace either. Each
+# requested atom costs one contiguous read, atoms not in the output are NaN. Without a selection the
+# values are a view of the read-only memory map itself, so nothing is read until it is indexed.
+def load_trajectories(filename, atoms=None):
+  filename = resolve_output(filename)
+  if not trajectory_cache_is_valid(filename):
+    convert_trajectories(filename)
+
+  values_path, meta_path = trajectory_cache_paths(filename)
+  with np.load(meta_path) as meta:
+    steps = meta['steps']
+    atom_ids = meta['atom_ids']
+  values = np.load(values_path, mmap_mode='r')
+
+  if atoms is not None:
+    requested = np.sort(np.asarray(atoms, dtype=np.int64))
+    rows = np.searchsorted(atom_ids, requested)
+    rows[rows == len(atom_ids)] = 0
+    found = atom_ids[rows] == requested if len(atom_ids) > 0 else np.zeros(len(requested), dtype=bool)
+
+    selection = np.full((len(requested), len(steps), 3), np.nan, dtype=values.dtype)
+    for i in np.flatnonzero(found):
+      selection[i] = values[rows[i]]
+    atom_ids = requested
+    values = selection
+
+  return steps, atom_ids, values.transpose(1, 0, 2)
@@ -1,9 +1,11 @@
 import json
 import os
+import sys
 import numpy as np
 import matplotlib.pyplot as plt
-import csv
-from ast import literal_eval
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'Python_common'))
+from capture_fraction_stats import load_statistics, statistic_index
 
 color_gradient = [
   (33.0, 32.0, 109.0),
@@ -18,33 +20,35 @@ color_grad_scaled = []
 for color in color_gradient:
   color_grad_scaled.append((color[0]/255.0, color[1]/255.0, color[2]/255.0))
 
-with open('cell_mot_output/detunings_offsets_run_4.csv', 'r') as f:
-  reader = csv.DictReader(f)
-
-  offset_capture_fractions = {}
+csv_filename = 'cell_mot_output/detunings_offsets_run_4.csv'
+store_filename = 'cell_mot_output/detunings_offsets_run_4.results'
 
-  for line in reader:
-    if line['offset delta'] in offset_capture_fractions.keys():
-      offset_capture_fractions[line['offset delta']].append(
-        np.mean(literal_eval(line['capture fraction array']))
-      )
-    else:
-      offset_capture_fractions[line['offset delta']] = [
-        np.mean(literal_eval(line['capture fraction array']))
-      ]
+# The statistics are cached next to the store, which is converted from the sweep csv the first time it is plotted
+statistics = load_statistics(store_filename, csv_filename)
+offset_deltas = statistics['offset_deltas']
+# The store holds the detuning magnitudes, the plots use the (negative) red detuning
+detunings = -np.asarray(statistics['detunings'])
+statistic = statistic_index('mean')
 
 f = plt.figure(figsize=(8.8, 6.4))
-detunings = np.arange(-10.0, -81.0, -1.0)
 offsets_to_plot = [0.0, 1.0, 2.0, 3.0, 4.0, 5.0]
-for offset in offset_capture_fractions.keys():
-  offset_mm = round(literal_eval(offset)*1e3, 1)
+for i, offset in enumerate(offset_deltas):
+  offset_mm = round(offset*1e3, 1)
   if offset_mm in offsets_to_plot:
     offset_label = str(offset_mm) + 'mm offset'
+    color = color_grad_scaled[offsets_to_plot.index(offset_mm)]
     plt.plot(
       detunings, 
-      offset_capture_fractions[offset], 
+      statistics['values'][statistic, i], 
       label=offset_label, 
-      color=color_grad_scaled[offsets_to_plot.index(offset_mm)])
+      color=color)
+    # Bootstrap confidence band of the mean
+    plt.fill_between(
+      detunings,
+      statistics['lower'][statistic, i],
+      statistics['upper'][statistic, i],
+      color=color,
+      alpha=0.2)
 
 plt.xlabel('detuning (MHz)')
 plt.ylabel('capture fraction')
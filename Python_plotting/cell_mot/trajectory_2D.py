@@ -1,42 +1,23 @@
+import os
+import sys
 import numpy as np
 import matplotlib.pyplot as plt
 import csv
 
-def get_pos_arrays(atoms, filename):
-  atom_positions = [[] for i in range(len(atoms))]
-  atoms.sort()
-
-  with open(filename, 'r') as f:
-    atom = 0
-    step = 0
-    for line in f:
-      if line.startswith('step'):
-        step += 1
-        atom = 0
-      else:
-        if int(line.split(',')[1].split(':')[0]) in atoms:
-          x = float(line.split('(')[1].split(',')[0])
-          y = float(line.split('(')[1].split(',')[1])
-          z = float(line.split('(')[1].split(',')[2].split(')')[0])
-
-          atom_positions[atom].append((x, y, z))
-          atom += 1
-
-  return atom_positions
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'Python_common'))
+from trajectory_cache import load_trajectories
 
 # atoms = np.arange(0, 30, 1)
 atoms = [8,9,10,11,12,13,14]
-pos_arrays = get_pos_arrays(atoms, "cell_mot_output/pos.txt")
+steps, atom_ids, positions = load_trajectories("cell_mot_output/pos.txt", atoms=atoms)
 
 x_cutoff = 0.03
 z_cutoff = 0.0032
 for i, atom in enumerate(atoms):
-  x_arr = []
-  z_arr = []
-  for pos in pos_arrays[i]:
-    if abs(pos[0]) < x_cutoff and abs(pos[2]) < z_cutoff:
-      x_arr.append(pos[0])
-      z_arr.append(pos[2])
+  # Atoms lost from the simulation volume are NaN, which fail the cutoff comparison
+  in_cutoff = (np.abs(positions[:, i, 0]) < x_cutoff) & (np.abs(positions[:, i, 2]) < z_cutoff)
+  x_arr = positions[in_cutoff, i, 0]
+  z_arr = positions[in_cutoff, i, 2]
 
   if i==0:
     plt.plot(x_arr, z_arr, 'b-', label='atom trajectories')
@@ -1,57 +1,69 @@
+import os
+import sys
 import numpy as np
 import matplotlib.pyplot as plt
 from matplotlib.ticker import MultipleLocator
 import csv
-from scipy.fftpack import fft
-
-def get_pos_arrays(atoms, filename):
-  atom_positions = [[] for i in range(len(atoms))]
-  atoms.sort()
-
-  with open(filename, 'r') as f:
-    atom = 0
-    step = 0
-    for line in f:
-      if line.startswith('step'):
-        step += 1
-        atom = 0
-      else:
-        if int(line.split(',')[1].split(':')[0]) in atoms:
-          x = float(line.split('(')[1].split(',')[0])
-          y = float(line.split('(')[1].split(',')[1])
-          z = float(line.split('(')[1].split(',')[2].split(')')[0])
-
-          atom_positions[atom].append((x, y, z))
-          atom += 1
-
-  return atom_positions
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'Python_common'))
+from trajectory_cache import load_trajectories
+from oscillation_spectra import amplitude_spectra, oscillation_spectra, resonance_comparison, sample_spacing
+
+# Plot the spectra of every atom in the run together, instead of the atoms below
+plot_ensemble = False
 
 # atoms = [1, 43, 72, 115, 304]
 atoms = [0]
-pos_arrays = get_pos_arrays(atoms, "shell_trap_output/pos.txt")
+steps, atom_ids, positions = load_trajectories("shell_trap_output/pos.txt", atoms=None if plot_ensemble else atoms)
 
 # Fourier transform
 
-# Number of sample points
-N = 1000
+# Simulation timestep, positions are written every few of these
+timestep = 4.0e-5
 # Sample spacing
-T = 4.0e-4
+T = sample_spacing(steps, timestep)
 # FFT cutoff
 lower_cutoff = 3
 upper_cutoff = 150
+# Resonant frequency from theory
+resonance = 132.0
 
-xf = np.linspace(0.0, 1.0/T, N//2)
+# Frequencies of the cutoffs, the band searched for each atom's dominant frequency
+min_frequency = lower_cutoff / (len(steps) * T)
+max_frequency = upper_cutoff / (len(steps) * T)
 
 plot_all_atoms = False
-if plot_all_atoms:
+if plot_ensemble:
+  spectra = oscillation_spectra(positions, T, min_frequency, max_frequency)
+  comparison = resonance_comparison(spectra['dominant_frequencies'], resonance)
+  for j, axis in enumerate(['x', 'y', 'z']):
+    print(
+      axis + ': dominant frequency ' + str(round(comparison['mean'][j], 1)) + ' +/- ' + str(round(comparison['stdev'][j], 1)) + ' Hz'
+      + ' over ' + str(comparison['number of atoms'][j]) + ' atoms, '
+      + str(round(comparison['fraction within tolerance'][j] * 100, 1)) + '% within 5 Hz of ' + str(resonance) + ' Hz')
+
+  fig, ax = plt.subplots(nrows=1, ncols=2, figsize=(12, 5))
+  for j, axis in enumerate(['x', 'y', 'z']):
+    ax[0].semilogy(spectra['welch_frequencies'], spectra['welch_spectrum'][:, j], label=axis)
+    ax[1].hist(spectra['dominant_frequencies'][:, j], bins=100, histtype='step', label=axis)
+  for a in ax:
+    a.axvline(resonance, color='red', label='resonant frequency from theory')
+    a.set_xlabel('frequency (Hz)')
+    a.grid(which='major', linestyle='-')
+    a.legend(loc='upper right')
+  ax[0].set_xlim([0, max_frequency])
+  ax[0].set_ylabel('mean power spectral density (m^2/Hz)')
+  ax[1].set_ylabel('number of atoms')
+  fig.suptitle('Ensemble position spectra and dominant frequencies')
+  plt.show()
+
+elif plot_all_atoms:
+  xf, yf = amplitude_spectra(positions, T)
   fig, ax = plt.subplots(nrows=1, ncols=3)
   for j in range(0, 3):
-    for i, atom in enumerate(atoms):
-      pos_array = [pos[j] for pos in pos_arrays[i]]
-      yf = fft(pos_array)
-
+    for i, atom in enumerate(atom_ids):
       atom_label = 'atom ' + str(atom)
-      ax[j].plot(xf[:cutoff], np.abs(yf[:cutoff]), label=atom_label)
+      ax[j].plot(xf[lower_cutoff:upper_cutoff], yf[lower_cutoff:upper_cutoff, i, j], label=atom_label)
 
   ax[0].set_ylabel('fft amplitude')
   ax[0].set_xlabel('x frequency (Hz)')
@@ -77,16 +89,15 @@ if plot_all_atoms:
   plt.show()
 
 else:
-  z_pos_array = [pos[2] for pos in pos_arrays[0]]
-  yf = fft(z_pos_array)
-  plt.plot(xf[lower_cutoff:upper_cutoff], np.abs(yf[lower_cutoff:upper_cutoff]), label='fourier transform of the z position')
+  xf, yf = amplitude_spectra(positions[:, 0, 2], T)
+  plt.plot(xf[lower_cutoff:upper_cutoff], yf[lower_cutoff:upper_cutoff], label='fourier transform of the z position')
   plt.xlabel('frequency (Hz)')
   plt.ylabel('FFT amplitude')
 
   plt.grid(which='major', linestyle='-')
   plt.minorticks_on()
   plt.grid(which='minor', linestyle='-', color='lightgrey')
-  plt.vlines(132, 0, max([np.abs(x) for x in yf[lower_cutoff:upper_cutoff]]), color='red', label='resonant frequency from theory')
+  plt.vlines(resonance, 0, np.max(yf[lower_cutoff:upper_cutoff]), color='red', label='resonant frequency from theory')
   plt.ylim(ymin=0)
   plt.xlim(xmin=0)
   plt.legend(loc='upper right')
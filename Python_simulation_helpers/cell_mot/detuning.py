@@ -3,9 +3,28 @@ import os
 import numpy as np
 import matplotlib.pyplot as plt
 import csv
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'Python_common'))
+from atomecs_output import read_atom_count
+from simulation_runner import SimulationRunner
+from evaluation_cache import EvaluationCache
+from sequential_sampling import has_converged
+from results_store import append_results
+
+runner = SimulationRunner('cell_mot_offsets_detuning')
+
+# Stop repeating a detuning once the standard error on its mean capture fraction is below the target
+adaptive_sims = True
+min_sims = 15
+target_capture_fraction_error = 0.01
+
+# Cache of capture fractions keyed by the sim parameters and repeat number, so restarted sweeps skip finished repeats
+evaluation_cache = EvaluationCache('cell_mot_output/capture_fraction_cache.sqlite')
 
 # Function for running a 3D Pyramid MOT simulation with a specific detuning
-def simulate(offset_delta, detuning, number_of_steps, number_of_sims):
+# If a target error is given, stop early once the capture fraction has converged (see sequential_sampling)
+def simulate(offset_delta, detuning, number_of_steps, number_of_sims, min_sims=None, target_error=None):
   # Create the interface file
   params = {
     "offset_delta": offset_delta,
@@ -18,37 +37,53 @@ def simulate(offset_delta, detuning, number_of_steps, number_of_sims):
 
   capture_fractions = []
   for i in range(number_of_sims):
+    if target_error is not None and has_converged(capture_fractions, target_error, min_sims, number_of_sims):
+      break
+
+    cached_capture_fraction = evaluation_cache.get(dict(params, repeat=i))
+    if cached_capture_fraction is not None:
+      capture_fractions.append(cached_capture_fraction)
+      continue
+
     print('\nRunning sim number ' + str(i+1) + ' for offset delta ' + str(offset_delta) + ' and detuning ' + str(detuning) +'\n')
     # Run the rust sim
-    cmd = "cargo run --example cell_mot_offsets_detuning --release"
-    os.system(cmd)
+    runner.run()
 
     capture_fraction = calculate_capture_fraction("cell_mot_output/pos.txt", number_of_steps, 1000)
     capture_fractions.append(capture_fraction)
+    evaluation_cache.put(dict(params, repeat=i), capture_fraction)
+
+  num_runs, mean_overhead = runner.overhead_summary()
+  print('Mean launch overhead over ' + str(num_runs) + ' runs: ' + str(round(mean_overhead, 1)) + ' ms')
 
   return capture_fractions
 
 def calculate_capture_fraction(filename, number_of_steps, number_of_atoms):
-  with open(filename, 'r') as fh:
-    for line in fh:
-        if line.startswith("step-" + str(number_of_steps)):
-          return int(line.split(', ')[1]) / number_of_atoms
+  return read_atom_count(filename, number_of_steps) / number_of_atoms
 
-# Output sim results to csv file for retrospective analysis with file flushing
-header = ['detuning', 'offset delta', 'number of steps', 'capture fraction array']
+# Output sim results to csv file for retrospective analysis with file flushing, and to a results store
+# (see results_store) which the plotting scripts can load without parsing list literals
+header = ['detuning', 'offset delta', 'number of steps', 'capture fraction array', 'number of sims']
+store_filename = 'cell_mot_output/run_3.results'
+if os.path.exists(store_filename):
+  os.remove(store_filename)
 with open('cell_mot_output/run_3.csv', 'w') as f:
   writer = csv.writer(f)
   writer.writerow(header)
 
   offset_delta = 0.0
+  number_of_steps = 5000
   for detuning in np.arange(10.0, 81.0, 1.0):
 
     capture_fractions = simulate(
       offset_delta=offset_delta,
       detuning=-detuning, 
-      number_of_steps=5000, 
-      number_of_sims=100)
+      number_of_steps=number_of_steps, 
+      number_of_sims=100,
+      min_sims=min_sims,
+      target_error=target_capture_fraction_error if adaptive_sims else None)
 
-    data = [detuning, offset_delta, number_of_steps, capture_fractions]
+    data = [detuning, offset_delta, number_of_steps, capture_fractions, len(capture_fractions)]
     writer.writerow(data)
     f.flush()
+    append_results(store_filename, offset_delta, detuning, number_of_steps, np.arange(len(capture_fractions)), capture_fractions)
@@ -1,77 +1,52 @@
-import json
 import os
 import numpy as np
-import matplotlib.pyplot as plt
-import csv
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'Python_common'))
+from simulation_runner import SimulationRunner
+from sweep_scheduler import expand_jobs, import_csv_into_ledger, run_adaptive_sweep, run_sweep, write_sweep_csv, write_sweep_store
 
 old_filename = 'cell_mot_output/detunings_offsets_run_3.csv'
 new_filename = 'cell_mot_output/detunings_offsets_run_4.csv'
+new_store_filename = 'cell_mot_output/detunings_offsets_run_4.results'
+ledger_filename = 'cell_mot_output/detunings_offsets_ledger.jsonl'
 
-# Function for running a 3D Pyramid MOT simulation with a specific detuning
-def simulate(offset_delta, detuning, number_of_steps, number_of_sims):
-  # Create the interface file
-  params = {
-    "offset_delta": offset_delta,
-    "detuning": detuning,
-    "number_of_steps": number_of_steps
-  }
-
-  with open("offsets.json", "w") as outfile:
-    json.dump(params, outfile)
-
-  capture_fractions = []
-  for i in range(number_of_sims):
-    print('\nRunning sim number ' + str(i+1) + ' for offset delta ' + str(offset_delta) + ' and detuning ' + str(detuning) +'\n')
-    # Run the rust sim
-    cmd = "cargo run --example cell_mot_offsets_detuning --release"
-    os.system(cmd)
-
-    capture_fraction = calculate_capture_fraction("cell_mot_output/pos.txt", number_of_steps, 1000)
-    capture_fractions.append(capture_fraction)
+# Number of simulations run in parallel, each in its own sandbox directory
+num_workers = os.cpu_count()
 
-  return capture_fractions
+# Stop repeating a grid point once the standard error on its mean capture fraction is below the target
+adaptive_sims = True
+min_sims = 15
+target_capture_fraction_error = 0.01
 
-def calculate_capture_fraction(filename, number_of_steps, number_of_atoms):
-  with open(filename, 'r') as fh:
-    for line in fh:
-        if line.startswith("step-" + str(number_of_steps)):
-          return int(line.split(', ')[1]) / number_of_atoms
+runner = SimulationRunner('cell_mot_offsets_detuning')
 
-already_simulated = {}
-header = ['detuning', 'offset delta', 'number of steps', 'capture fraction array']
-with open(old_filename, 'r') as old_f, open(new_filename, 'w') as new_f:
-  reader = csv.reader(old_f)
-  writer = csv.writer(new_f)
-  writer.writerow(header)
+if __name__ == '__main__':
+  # Carry over the results of the previous run into the job ledger the first time the sweep is started
+  if not os.path.exists(ledger_filename) and os.path.exists(old_filename):
+    import_csv_into_ledger(old_filename, ledger_filename)
 
-  # Loop through output file and store already outputted offsets and detunings
-  for line in reader:
-    if len(line) > 0 and line[0] != 'detuning':
-      writer.writerow(line)
-      detuning = float(line[0])
-      offset = float(line[1])
-      if offset in already_simulated.keys():
-        already_simulated[offset].append(detuning)
-      else:
-        already_simulated[offset] = [detuning]
-
-  new_f.flush()
-
-  # Output sim results to csv file for retrospective analysis with file flushing
+  # Run every offset, detuning and repeat which isn't in the ledger yet, and output the sim
+  # results to csv for retrospective analysis
   number_of_steps = 5000
-  for offset_delta in np.arange(0.0, 0.0051, 0.0005):
-    for detuning in np.arange(10.0, 81.0, 1.0):
-
-      if offset_delta in already_simulated.keys() and detuning in already_simulated[offset_delta]:
-        print('Skipping offset ' + str(offset_delta) + ' and detuning ' + str(detuning))
-      else:
-        capture_fractions = simulate(
-          offset_delta=offset_delta,
-          detuning=-detuning, 
-          number_of_steps=number_of_steps, 
-          number_of_sims=100)
-
-        data = [detuning, offset_delta, number_of_steps, capture_fractions]
-        writer.writerow(data)
-        new_f.flush()
-  
+  number_of_sims = 100
+  offset_deltas = np.arange(0.0, 0.0051, 0.0005)
+  detunings = np.arange(10.0, 81.0, 1.0)
+
+  if adaptive_sims:
+    finished = run_adaptive_sweep(
+      offset_deltas,
+      detunings,
+      number_of_steps,
+      runner,
+      ledger_filename,
+      min_sims=min_sims,
+      max_sims=number_of_sims,
+      target_error=target_capture_fraction_error,
+      num_workers=num_workers
+    )
+  else:
+    jobs = expand_jobs(offset_deltas, detunings, number_of_steps, number_of_sims)
+    finished = run_sweep(jobs, runner, ledger_filename, num_workers=num_workers)
+  write_sweep_csv(new_filename, finished, offset_deltas, detunings, number_of_steps, number_of_sims)
+  write_sweep_store(new_store_filename, finished, offset_deltas, detunings, number_of_steps, number_of_sims)
@@ -1,21 +1,88 @@
 import json 
 import os
+import sys
 import numpy as np
 import matplotlib.pyplot as plt
 import csv
 import math
-from scipy.optimize import differential_evolution
+from concurrent.futures import ProcessPoolExecutor
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'Python_common'))
+from atomecs_output import read_output, read_step
+from simulation_runner import SimulationRunner, output_plan, run_simulation, run_simulation_batch
+from output_stream import PairedFrames, stream_simulation
+from simulation_supervisor import Supervisor, load_best, reset_best, save_best
+from phase_space_density import phase_space_density
+from evaluation_cache import EvaluationCache
+from de_checkpoint import load_checkpoint, open_iteration_csv, resumable_differential_evolution
+from surrogate_optimizer import benchmark, surrogate_minimize
+from multi_fidelity import ScreenedPopulationMap
 
 # Parameter ranges for optimisation
 # Quad gradient = 50G/cm - 150G/cm, RF frequency = 2MHz - 20MHz, RF amplitude = 50kHz - 250kHz
 
 debug = False
 
+# Number of simulations run in parallel, each in its own sandbox directory
+num_workers = os.cpu_count()
+runner = SimulationRunner('mode_match_shell', log_filename='shell_trap_output/launch_overhead.csv')
+
+# Cache of PSDs from previous evaluations, shared between workers and runs
+evaluation_cache = EvaluationCache('shell_trap_output/psd_cache.sqlite')
+
 iteration_num = 0
 current_PSD = 0
 num_sim_steps = 10000
+# Width of the PSD bounding box as a fraction of the x range of the cloud
+PSD_box_fraction = 0.05
 initial_velocity_std = 0.02779
 params_file_name = 'shell_trap_output/optimize_params_differential_out_10.csv'
+checkpoint_file_name = 'shell_trap_output/optimize_params_differential_out_10_checkpoint.npz'
+checkpoint_every = 1
+
+# Optimiser to use: 'differential evolution', 'surrogate' (Gaussian process with batched expected
+# improvement, one batch per worker pool) or 'benchmark' to compare their evaluations to reach benchmark_PSD
+optimizer = 'differential evolution'
+surrogate_params_file_name = 'shell_trap_output/optimize_params_surrogate_out_10.csv'
+surrogate_maxiter = 100
+benchmark_PSD = 1e20
+benchmark_max_evaluations = 2000
+
+# Multi-fidelity screening of each differential evolution generation: every candidate is scored with
+# the cheapest fidelity level, and only the best 1/screening_eta at each level are run at the next one
+screening = True
+screening_eta = 3
+fidelity_levels = [
+  {"atom_number": 1000, "num_steps": 2500},
+  {"atom_number": 3000, "num_steps": 5000},
+  {"atom_number": 10000, "num_steps": num_sim_steps}
+]
+fidelity_log_file_name = 'shell_trap_output/optimize_params_differential_out_10_fidelity.csv'
+population_map = None
+
+# Stream the position and velocity output of each run through named pipes into the PSD calculation,
+# instead of writing it to disk and reading it back once the run has finished
+stream_output = True
+
+# Evaluate each generation with vectorized=True, running batches of parameter sets in one simulation
+# process each, so process startup is paid once per batch rather than once per parameter set. Not used
+# when screening, which evaluates every fidelity level separately.
+batch_evaluation = False
+batch_pool = None
+
+# Early termination of hopeless candidates: each run also writes monitor output for a subset of its atoms,
+# which a supervisor tails while it runs. From prune_after_step, a run is stopped and scored as pruned_PSD
+# once fewer than min_atom_fraction of its atoms are left, or once its running PSD estimate is still below
+# the best PSD so far after multiplying by prune_optimism.
+prune_hopeless = True
+monitor_interval = 500
+monitor_atom_stride = 20
+prune_after_step = 1000
+min_atom_fraction = 0.2
+prune_optimism = 10
+pruned_PSD = 0.0
+best_file_name = 'shell_trap_output/optimize_params_differential_out_10_best.json'
+
 standard_params = {
   "atom_number": 10000, 
   "num_steps": num_sim_steps, 
@@ -34,23 +101,8 @@ standard_params = {
 
 # Calculate the average KE of atoms in the trap (for the final time step only)
 def calculate_average_KE(vel_filename, mass, number_of_steps):
-  with open(vel_filename, 'r') as f:
-    reached_last_step = False
-    atom_KEs = []
-    for line in f:
-      if reached_last_step:
-        vx = float(line.split('(')[1].split(',')[0])
-        vy = float(line.split('(')[1].split(',')[1])
-        vz = float(line.split('(')[1].split(',')[1].split(')')[0])
-
-        v = math.sqrt(vx**2 + vy**2 + vz**2)
-        KinEnergy = 0.5 * mass * v**2
-
-        atom_KEs.append(KinEnergy)
-
-      if line.startswith("step-" + str(number_of_steps)):
-        reached_last_step = True
-  
+  atom_ids, atom_velocities = read_step(vel_filename, number_of_steps)
+  atom_KEs = 0.5 * mass * np.sum(atom_velocities**2, axis=1)
   return np.average(atom_KEs)
 
 # Function to calculate the size of the resonant shell trapping spheroid
@@ -60,132 +112,245 @@ def calculate_z0(rf_frequency, quad_grad):
 
 # Function to calculate the equivalent PSD at a given timestep
 def calculate_timestep_PSD(pos_filename, vel_filename, mass, timestep, z0):
-  atom_positions = []
-  atom_velocities_squared = []
-
-  # Extract positions and velocities in the final time step from the files given
-  with open(pos_filename, 'r') as f:
-    reached_time_step = False 
-    for line in f:
-      if line.startswith("step-" + str(timestep)):
-        reached_time_step = True
-        continue
-      elif line.startswith("step-") and int(line.split('-')[1].split(',')[0]) > timestep:
-        break
-
-      if reached_time_step:
-        x = float(line.split('(')[1].split(',')[0])
-        y = float(line.split('(')[1].split(',')[1])
-        z = float(line.split('(')[1].split(',')[1].split(')')[0])
-
-        atom_positions.append([x,y,z])
-
-  with open(vel_filename, 'r') as f:
-    reached_time_step = False
-    for line in f:
-      if line.startswith("step-" + str(timestep)):
-        reached_time_step = True
-        continue
-      elif line.startswith("step-") and int(line.split('-')[1].split(',')[0]) > timestep:
-        break
-
-      if reached_time_step:
-        vx = float(line.split('(')[1].split(',')[0])
-        vy = float(line.split('(')[1].split(',')[1])
-        vz = float(line.split('(')[1].split(',')[1].split(')')[0])
-
-        v2 = vx**2 + vy**2 + vz**2
-        atom_velocities_squared.append(v2)    
-
-  # Calculate the range of x values in the shell trap and the size of the PSD bounding box
-  x_min = np.array(atom_positions).min(axis=0)[0]
-  x_max = np.array(atom_positions).max(axis=0)[0]
-  x_range = x_max - x_min
-  bounding_box_width = 0.5 * 0.05 * x_range
-
-  # Calculate the atoms inside the bounding box
-  bounded_atom_indexes = []
-  for i, atom_pos in enumerate(atom_positions):
-    if np.abs(atom_pos[0]) < bounding_box_width:
-      bounded_atom_indexes.append(i)
-
-  num_bounded_atoms = len(bounded_atom_indexes)
-
-  # Calculate the average kinetic energy for the bounded atoms
-  atom_KEs_total = 0
-  for i in bounded_atom_indexes:
-    atom_KEs_total += 0.5 * mass * atom_velocities_squared[i]
-  
-  atom_KE_average = atom_KEs_total / num_bounded_atoms
-
-  # Calculate the atom density and the phase space density
-  n = num_bounded_atoms / math.pow(bounding_box_width * 2, 3)
-  phase_space_density = n / math.pow(atom_KE_average, 1.5)
-
-  return phase_space_density
+  # Extract positions and velocities in the given time step from the files given
+  pos_atom_ids, atom_positions = read_step(pos_filename, timestep)
+  vel_atom_ids, atom_velocities = read_step(vel_filename, timestep)
+  return frame_PSD(atom_positions, atom_velocities, mass)
 
-# Function to return the time averaged PSD
-def get_PSD(params_arr):
-  quad_grad, rf_freq, rf_amp = params_arr
-  global current_PSD
+# Function to calculate the equivalent PSD from the positions and velocities of the atoms in one frame
+def frame_PSD(atom_positions, atom_velocities, mass):
+  counts, mean_KEs, PSDs = phase_space_density(atom_positions[None], atom_velocities[None], mass, [PSD_box_fraction])
+  return PSDs[0, 0]
+
+# Function to return the steps the PSD is averaged over, the last quarter of the run at multiples of 100 steps
+def PSD_steps(num_steps):
+  return np.arange(math.ceil(num_steps*0.75 / 100) * 100, num_steps + 1, 100)
 
+# Function to return the simulation parameters for a parameter vector
+# fidelity: optional dict of standard_params overrides, such as a reduced atom_number and num_steps
+# monitored: whether to write the monitor output for pruning, which is only read when a supervisor runs
+def make_params(params_arr, fidelity=None, monitored=True):
+  quad_grad, rf_freq, rf_amp = params_arr
   z0 = calculate_z0(rf_freq, quad_grad)
 
-  params = standard_params
-  params['quad_grad_initial'] = quad_grad
-  params['rf_frequency'] = rf_freq
-  params['rf_amp'] = rf_amp
+  params = dict(standard_params)
+  params['quad_grad_initial'] = float(quad_grad)
+  params['rf_frequency'] = float(rf_freq)
+  params['rf_amp'] = float(rf_amp)
   params['mot_position_z'] = -z0
+  if fidelity is not None:
+    params.update(fidelity)
+
+  # Only output the positions and velocities at the steps the PSD is averaged over
+  steps = PSD_steps(params['num_steps'])
+  params['output'] = [
+    output_plan('position', 'pos.txt', 100, start=steps[0], end=steps[-1]),
+    output_plan('velocity', 'vel.txt', 100, start=steps[0], end=steps[-1])
+  ]
+  if prune_hopeless and monitored:
+    params['output'] += [
+      output_plan('position', 'monitor_pos.txt', monitor_interval, end=params['num_steps'], atom_stride=monitor_atom_stride),
+      output_plan('velocity', 'monitor_vel.txt', monitor_interval, end=params['num_steps'], atom_stride=monitor_atom_stride)
+    ]
+  return params
+
+# Function to return the simulation parameters without the output plan, used as the evaluation cache key,
+# so that runs writing different output (e.g. batch runs without monitor output) share cached results
+def cache_params(params):
+  return {name: value for name, value in params.items() if name != 'output'}
+
+# Function to return a time averaged PSD, scored as pruned_PSD if it isn't finite
+#
+# The PSD of a step is NaN when no atoms are left in its bounding box, and differential evolution can't
+# rank NaN energies (it would take such a member as the best), so these runs are scored like pruned ones.
+def finite_PSD(PSD):
+  return float(PSD) if np.isfinite(PSD) else pruned_PSD
+
+# Function to return the time averaged PSD from the output directory of a run
+def output_PSD(output_dir, params):
+  steps = PSD_steps(params['num_steps'])
+  pos_steps, atom_ids, atom_positions = read_output(os.path.join(output_dir, 'pos.txt'), steps=steps)
+  vel_steps, atom_ids, atom_velocities = read_output(os.path.join(output_dir, 'vel.txt'), atoms=atom_ids, steps=steps)
+
+  # Evaluate every step at once
+  counts, mean_KEs, PSDs = phase_space_density(atom_positions, atom_velocities, 1.0, [PSD_box_fraction])
+  return finite_PSD(np.average(PSDs[:, 0]))
+
+# Function to run a simulation and return its time averaged PSD, calculated from the output as it is streamed
+# Returns None if the supervisor stopped the run.
+def stream_PSD(params, supervisor=None):
+  paired = PairedFrames(PSD_steps(params['num_steps']), lambda step, atom_positions, atom_velocities: frame_PSD(atom_positions, atom_velocities, 1.0))
+  completed = stream_simulation(runner, params, {
+    'shell_trap_output/pos.txt': paired.component(0),
+    'shell_trap_output/vel.txt': paired.component(1)
+  }, supervisor=supervisor)
+  # Averaged over every step in PSD_steps, like output_PSD: ordered_results raises if any is missing from the stream
+  return finite_PSD(np.average(paired.ordered_results())) if completed else None
 
-  with open('input.json', 'w') as f:
-    json.dump(params, f)
-    f.flush()
-
-  cmd = 'cargo run --example mode_match_shell --release'
-  os.system(cmd)
-
-  psd_array = []
-  for timestep in np.arange(7500, 10001, 100):
-    psd_array.append(calculate_timestep_PSD(
-      'shell_trap_output/pos.txt', 
-      'shell_trap_output/vel.txt', 
-      1.0, 
-      timestep, 
-      z0
-    ))
-    
-  current_PSD = np.average(psd_array)
+# Function to return a supervisor for a run, which stops it once it can't beat the best PSD so far
+def PSD_supervisor(params):
+  best_PSD = load_best(best_file_name)
+  # The PSD scales with the number of atoms, so estimates from reduced fidelity runs are scaled up
+  atom_scale = standard_params['atom_number'] / params['atom_number']
+
+  def prune(statistics):
+    step, atom_count = statistics.latest_atom_count()
+    if step is None or step < prune_after_step:
+      return False
+    if atom_count < min_atom_fraction * params['atom_number']:
+      return True
+
+    step, atom_positions, atom_velocities = statistics.latest_frame()
+    if best_PSD is None or step is None:
+      return False
+    # The estimate is NaN if no monitored atoms are in the PSD bounding box, which the subset is too small to judge on
+    PSD_estimate = frame_PSD(atom_positions, atom_velocities, 1.0) * monitor_atom_stride * atom_scale
+    return PSD_estimate * prune_optimism < best_PSD
+
+  return Supervisor(
+    {'position': 'shell_trap_output/monitor_pos.txt', 'velocity': 'shell_trap_output/monitor_vel.txt'},
+    prune,
+    atom_stride=monitor_atom_stride
+  )
+
+# Function to return the time averaged PSD
+# fidelity: optional dict of standard_params overrides, such as a reduced atom_number and num_steps
+def get_PSD(params_arr, fidelity=None):
+  global current_PSD
+  params = make_params(params_arr, fidelity)
+
+  cached_PSD = evaluation_cache.get(cache_params(params))
+  if cached_PSD is not None:
+    # Caches written before non-finite PSDs were scored as pruned can still hold NaN
+    current_PSD = finite_PSD(cached_PSD)
+    return -current_PSD
+
+  supervisor = PSD_supervisor(params) if prune_hopeless else None
+  if stream_output:
+    current_PSD = stream_PSD(params, supervisor)
+  else:
+    sandbox = run_simulation(runner, params, supervisor=supervisor)
+    current_PSD = None if sandbox is None else output_PSD(os.path.join(sandbox, 'shell_trap_output'), params)
+
+  # Pruned runs aren't cached, as the decision depends on the best PSD at the time
+  if current_PSD is None:
+    current_PSD = pruned_PSD
+    return -current_PSD
+
+  evaluation_cache.put(cache_params(params), float(current_PSD))
   return -current_PSD
 
+# Function to run a list of parameter sets in a single simulation process and return their PSDs
+def run_PSD_batch(params_list):
+  output_dirs = run_simulation_batch(runner, params_list)
+  PSDs = []
+  for output_dir, params in zip(output_dirs, params_list):
+    PSDs.append(output_PSD(output_dir, params))
+    evaluation_cache.put(cache_params(params), float(PSDs[-1]))
+  return PSDs
+
+# Vectorized objective for differential_evolution(vectorized=True), taking parameter sets as the
+# columns of an array of shape (3, S). The uncached sets are split into num_workers batches, and each
+# batch is evaluated by one simulation process.
+def get_PSD_batch(params_arrs):
+  global batch_pool
+  # No supervisor runs in batch mode, so the monitor output would never be read
+  params_list = [make_params(params_arr, monitored=False) for params_arr in np.asarray(params_arrs).T]
+  cached_PSDs = [evaluation_cache.get(cache_params(params)) for params in params_list]
+  PSDs = np.array([np.nan if PSD is None else PSD for PSD in cached_PSDs])
+
+  uncached = np.flatnonzero(np.isnan(PSDs))
+  if len(uncached) > 0:
+    if batch_pool is None:
+      batch_pool = ProcessPoolExecutor(max_workers=num_workers)
+    batches = [batch for batch in np.array_split(uncached, num_workers) if len(batch) > 0]
+    results = batch_pool.map(run_PSD_batch, [[params_list[i] for i in batch] for batch in batches])
+    for batch, batch_PSDs in zip(batches, results):
+      PSDs[batch] = batch_PSDs
+  return -PSDs
+
 # Output function to write parameters to file in scipy callback
-def write_params_to_file(params_arr, convergence):
-  quad_grad, rf_freq, rf_amp = params_arr
+# The objective runs in worker processes, so the best PSD is taken from the intermediate result
+def write_params_to_file(intermediate_result):
+  quad_grad, rf_freq, rf_amp = intermediate_result.x
   global iteration_num
-  global current_PSD
-  writer.writerow([iteration_num, quad_grad, rf_freq, rf_amp, current_PSD])
+  if population_map is not None:
+    fidelity_level = population_map.fidelity_level(intermediate_result.x)
+  else:
+    fidelity_level = len(fidelity_levels) - 1
+  writer.writerow([iteration_num, quad_grad, rf_freq, rf_amp, -intermediate_result.fun, fidelity_level])
   f.flush()
+  save_best(best_file_name, -intermediate_result.fun)
   iteration_num += 1
 
-if debug:
-  print(calculate_z0(7, 120))
-  # print(calculate_z0(15.7, 50))
-  # print(calculate_timestep_PSD("shell_trap_output/pos.txt", "shell_trap_output/vel.txt", 1.0, 9000, 520e-6))
-
-else:
-  # Run differential evolution and output parameter evolution to a file
-  kHzToGauss = 0.002857
-  bounds = [(25, 100), (14, 16), (50 * kHzToGauss, 250 * kHzToGauss)]
-  with open(params_file_name, 'w') as f:
-    header = ['iteration number', 'quad gradient', 'rf frequency', 'rf amplitude', 'Phase space density']
-    writer = csv.writer(f)
-    writer.writerow(header)
-    res = differential_evolution(
-      get_PSD, 
-      bounds, 
-      maxiter=10000,
-      popsize=15,
-      mutation=0.7,
-      callback=write_params_to_file
-    )
-
-  print(res)
+if __name__ == '__main__':
+  if debug:
+    print(calculate_z0(7, 120))
+    # print(calculate_z0(15.7, 50))
+    # print(calculate_timestep_PSD("shell_trap_output/pos.txt", "shell_trap_output/vel.txt", 1.0, 9000, 520e-6))
+
+  else:
+    # Run the chosen optimiser and output parameter evolution to a file
+    kHzToGauss = 0.002857
+    bounds = [(25, 100), (14, 16), (50 * kHzToGauss, 250 * kHzToGauss)]
+    runner.resolve_binary()
+    header = ['iteration number', 'quad gradient', 'rf frequency', 'rf amplitude', 'Phase space density', 'fidelity level']
+    # Each campaign is pruned against its own best PSD, not one left by an earlier campaign. A resumed
+    # run starts from the best of its checkpointed population (whose energies are -PSD).
+    checkpoint = load_checkpoint(checkpoint_file_name) if optimizer == 'differential evolution' else None
+    reset_best(best_file_name, None if checkpoint is None else -np.min(checkpoint['population_energies']))
+    if optimizer == 'differential evolution':
+      objective, evaluation_kwargs = get_PSD, {'workers': num_workers}
+      if screening:
+        population_map = ScreenedPopulationMap(get_PSD, fidelity_levels, screening_eta, num_workers, fidelity_log_file_name)
+        evaluation_kwargs = {'workers': population_map}
+      elif batch_evaluation:
+        objective, evaluation_kwargs = get_PSD_batch, {'vectorized': True}
+
+      f, writer, iteration_num = open_iteration_csv(params_file_name, header, checkpoint_file_name)
+      with f:
+        res = resumable_differential_evolution(
+          objective, 
+          bounds, 
+          checkpoint_file_name,
+          checkpoint_every=checkpoint_every,
+          maxiter=10000,
+          popsize=15,
+          mutation=0.7,
+          callback=write_params_to_file,
+          updating='deferred',
+          **evaluation_kwargs
+        )
+      if population_map is not None:
+        population_map.close()
+      if batch_pool is not None:
+        batch_pool.shutdown()
+      print(res)
+
+    elif optimizer == 'surrogate':
+      with open(surrogate_params_file_name, 'w') as f:
+        writer = csv.writer(f)
+        writer.writerow(header)
+        res = surrogate_minimize(
+          get_PSD,
+          bounds,
+          maxiter=surrogate_maxiter,
+          batch_size=num_workers,
+          workers=num_workers,
+          callback=write_params_to_file
+        )
+      print(res.x, -res.fun, res.nfev)
+
+    elif optimizer == 'benchmark':
+      benchmark(
+        get_PSD,
+        bounds,
+        -benchmark_PSD,
+        benchmark_max_evaluations,
+        batch_size=num_workers,
+        workers=num_workers,
+        de_kwargs={'popsize': 15, 'mutation': 0.7}
+      )
+
+    hits, misses, entries = evaluation_cache.stats()
+    print('Evaluation cache: ' + str(hits) + ' hits, ' + str(misses) + ' misses, ' + str(entries) + ' entries')
@@ -1,21 +1,85 @@
 import json 
 import os
+import sys
 import numpy as np
 import matplotlib.pyplot as plt
 import csv
 import math
 from random import uniform
-from scipy.optimize import differential_evolution
+from concurrent.futures import ProcessPoolExecutor
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'Python_common'))
+from thermalisation import ThermalisationReducer, thermalisation_temperature, vel_squared_to_temperature
+from simulation_runner import SimulationRunner, output_plan, run_simulation, run_simulation_batch
+from output_stream import stream_simulation
+from simulation_supervisor import Supervisor, load_best, reset_best, save_best
+from evaluation_cache import EvaluationCache
+from de_checkpoint import load_checkpoint, open_iteration_csv, resumable_differential_evolution
+from surrogate_optimizer import benchmark, surrogate_minimize
+from multi_fidelity import ScreenedPopulationMap
 
 # Parameter ranges for optimisation
 # Quad gradient = 50G/cm - 150G/cm, RF frequency = 2MHz - 20MHz, RF amplitude = 50kHz - 250kHz
 
 debug = True
 
+# Number of simulations run in parallel, each in its own sandbox directory
+num_workers = os.cpu_count()
+runner = SimulationRunner('mode_match_shell', log_filename='shell_trap_output/launch_overhead.csv')
+
+# Cache of temperatures from previous evaluations, shared between workers and the repeated runs
+evaluation_cache = EvaluationCache('shell_trap_output/thermalisation_cache.sqlite')
+
 iteration_num = 0
 current_temp = 0
 num_sim_steps = 10000
 output_freq = 100
+checkpoint_every = 1
+
+# Optimiser to use: 'differential evolution' (99 restarts from random x0), 'surrogate' (Gaussian process
+# with batched expected improvement, one batch per worker pool) or 'benchmark' to compare their
+# evaluations to reach benchmark_temp
+optimizer = 'differential evolution'
+surrogate_params_file_name = 'shell_trap_output/optimize_params_surrogate_out_2.csv'
+surrogate_maxiter = 60
+benchmark_temp = 1e-4
+benchmark_max_evaluations = 2000
+
+# Multi-fidelity screening of each differential evolution generation: every candidate is scored with
+# the cheapest fidelity level, and only the best 1/screening_eta at each level are run at the next one
+screening = True
+screening_eta = 3
+fidelity_levels = [
+  {"atom_number": 1000, "num_steps": 2500},
+  {"atom_number": 3000, "num_steps": 5000},
+  {"atom_number": 10000, "num_steps": num_sim_steps}
+]
+fidelity_log_file_name = 'shell_trap_output/optimize_params_differential_out_2_fidelity.csv'
+population_map = None
+
+# Stream the velocity output of each run through a named pipe into the temperature calculation, instead
+# of writing it to disk and reading it back once the run has finished
+stream_output = True
+
+# Evaluate each generation with vectorized=True, running batches of parameter sets in one simulation
+# process each, so process startup is paid once per batch rather than once per parameter set. Not used
+# when screening, which evaluates every fidelity level separately.
+batch_evaluation = False
+batch_pool = None
+
+# Early termination of hopeless candidates: each run also writes monitor output for a subset of its atoms,
+# which a supervisor tails while it runs. From prune_after_step, a run is stopped and scored as pruned_temp
+# once fewer than min_atom_fraction of its atoms are left, or once its running temperature is still above
+# the best temperature so far after dividing by prune_optimism.
+prune_hopeless = True
+monitor_interval = 500
+monitor_atom_stride = 20
+prune_after_step = 1000
+min_atom_fraction = 0.2
+prune_optimism = 10
+pruned_temp = 1.0
+best_file_name = 'shell_trap_output/optimize_params_differential_out_2_best.json'
+
 initial_velocity_std = 0.02779
 standard_params = {
   "atom_number": 10000, 
@@ -38,87 +102,229 @@ def calculate_z0(rf_frequency, quad_grad):
   z0_cm = (rf_frequency) / (2 * 0.7 * quad_grad)
   return z0_cm * 1e-2
 
-# Function to return an array of arrays of |v|^2 of each atom at each timestep
-def get_vel_squared_arr(vel_filename, total_timesteps):
-  vel_squared_arr = [[] for _ in range(total_timesteps)]
-  with open(vel_filename, 'r') as f:
-    step = -1
-    for line in f:
-      if line.startswith("step-"):
-        step += 1
-        continue
+# Function to return the simulation parameters for a parameter vector
+# fidelity: optional dict of standard_params overrides, such as a reduced atom_number and num_steps
+# monitored: whether to write the monitor output for pruning, which is only read when a supervisor runs
+def make_params(params_arr, fidelity=None, monitored=True):
+  quad_grad, rf_freq, rf_amp = params_arr
+  z0 = calculate_z0(rf_freq, quad_grad)
+
+  params = dict(standard_params)
+  params['quad_grad_initial'] = float(quad_grad)
+  params['rf_frequency'] = float(rf_freq)
+  params['rf_amp'] = float(rf_amp)
+  params['mot_position_z'] = -z0
+  if fidelity is not None:
+    params.update(fidelity)
+
+  # Only output the velocities over the last quarter of the run, which the temperature is averaged over
+  num_steps = params['num_steps']
+  params['output'] = [output_plan('velocity', 'vel.txt', output_freq, start=math.ceil(num_steps*0.75 / output_freq) * output_freq, end=num_steps)]
+  if prune_hopeless and monitored:
+    params['output'] += [
+      output_plan('position', 'monitor_pos.txt', monitor_interval, end=num_steps, atom_stride=monitor_atom_stride),
+      output_plan('velocity', 'monitor_vel.txt', monitor_interval, end=num_steps, atom_stride=monitor_atom_stride)
+    ]
+  return params
+
+# Function to return the simulation parameters without the output plan, used as the evaluation cache key,
+# so that runs writing different output (e.g. batch runs without monitor output) share cached results
+def cache_params(params):
+  return {name: value for name, value in params.items() if name != 'output'}
+
+# Function to return the thermalisation temperature from the output directory of a run
+def output_temp(output_dir, params):
+  # Calculate the temperature from the averaged KE over the last quarter of the run
+  temp, steps, temp_curve = thermalisation_temperature(
+    os.path.join(output_dir, 'vel.txt'),
+    window_start=int(params['num_steps']*0.75),
+    window_end=params['num_steps']
+  )
+  return temp
+
+# Function to run a simulation and return its thermalisation temperature, calculated from the velocity
+# output as it is streamed. Returns None if the supervisor stopped the run.
+def stream_temp(params, supervisor=None):
+  reducer = ThermalisationReducer(window_start=int(params['num_steps']*0.75), window_end=params['num_steps'])
+  if not stream_simulation(runner, params, {'shell_trap_output/vel.txt': reducer}, supervisor=supervisor):
+    return None
+  temp, steps, temp_curve = reducer.result()
+  return temp
 
-      vx = float(line.split('(')[1].split(',')[0])
-      vy = float(line.split('(')[1].split(',')[1])
-      vz = float(line.split('(')[1].split(',')[1].split(')')[0])
+# Function to return a supervisor for a run, which stops it once it can't beat the best temperature so far
+def temp_supervisor(params):
+  best_temp = load_best(best_file_name)
 
-      v2 = vx**2 + vy**2 + vz**2
-      vel_squared_arr[step].append(v2)
+  def prune(statistics):
+    step, atom_count = statistics.latest_atom_count()
+    if step is None or step < prune_after_step:
+      return False
+    if atom_count < min_atom_fraction * params['atom_number']:
+      return True
 
-  return vel_squared_arr
+    if best_temp is None or len(statistics.mean_vel_squared) == 0:
+      return False
+    return vel_squared_to_temperature(statistics.mean_vel_squared[-1]) / prune_optimism > best_temp
+
+  return Supervisor(
+    {'position': 'shell_trap_output/monitor_pos.txt', 'velocity': 'shell_trap_output/monitor_vel.txt'},
+    prune,
+    atom_stride=monitor_atom_stride
+  )
 
 # Function to return the equivalent thermalisation temperature from a given AtomECS output
-def get_thermalisation_temp(params_arr):
-  quad_grad, rf_freq, rf_amp = params_arr
+# fidelity: optional dict of standard_params overrides, such as a reduced atom_number and num_steps
+def get_thermalisation_temp(params_arr, fidelity=None):
   global current_temp
+  params = make_params(params_arr, fidelity)
 
-  z0 = calculate_z0(rf_freq, quad_grad)
+  cached_temp = evaluation_cache.get(cache_params(params))
+  if cached_temp is not None:
+    current_temp = cached_temp
+    return current_temp
 
-  params = standard_params
-  params['quad_grad_initial'] = quad_grad
-  params['rf_frequency'] = rf_freq
-  params['rf_amp'] = rf_amp
-  params['mot_position_z'] = -z0
+  supervisor = temp_supervisor(params) if prune_hopeless else None
+  if stream_output:
+    current_temp = stream_temp(params, supervisor)
+  else:
+    sandbox = run_simulation(runner, params, supervisor=supervisor)
+    current_temp = None if sandbox is None else output_temp(os.path.join(sandbox, 'shell_trap_output'), params)
 
-  with open('input.json', 'w') as f:
-    json.dump(params, f)
-    f.flush()
+  # Pruned runs aren't cached, as the decision depends on the best temperature at the time
+  if current_temp is None:
+    current_temp = pruned_temp
+    return current_temp
 
-  cmd = 'cargo run --example mode_match_shell --release'
-  os.system(cmd)
+  evaluation_cache.put(cache_params(params), float(current_temp))
+  return current_temp
 
-  # Calculate the averaged KE over the last 2500 timesteps
-  vel_squared_arr = get_vel_squared_arr('shell_trap_output/vel.txt', int(num_sim_steps/output_freq))
-  average_vel_squared_arr = [np.mean(vel_arr) for vel_arr in vel_squared_arr[int((num_sim_steps/output_freq)*0.75):]]
-  average_vel_squared = np.mean(average_vel_squared_arr)
-  average_KE = 0.5 * 87 * 1.66054e-27 * average_vel_squared
-  current_temp = ((2/3) * average_KE) / 1.38065e-23
+# Function to run a list of parameter sets in a single simulation process and return their temperatures
+def run_temp_batch(params_list):
+  output_dirs = run_simulation_batch(runner, params_list)
+  temps = []
+  for output_dir, params in zip(output_dirs, params_list):
+    temps.append(output_temp(output_dir, params))
+    evaluation_cache.put(cache_params(params), float(temps[-1]))
+  return temps
 
-  return current_temp
+# Vectorized objective for differential_evolution(vectorized=True), taking parameter sets as the
+# columns of an array of shape (3, S). The uncached sets are split into num_workers batches, and each
+# batch is evaluated by one simulation process.
+def get_thermalisation_temp_batch(params_arrs):
+  global batch_pool
+  # No supervisor runs in batch mode, so the monitor output would never be read
+  params_list = [make_params(params_arr, monitored=False) for params_arr in np.asarray(params_arrs).T]
+  cached_temps = [evaluation_cache.get(cache_params(params)) for params in params_list]
+  temps = np.array([np.nan if temp is None else temp for temp in cached_temps])
+
+  uncached = np.flatnonzero(np.isnan(temps))
+  if len(uncached) > 0:
+    if batch_pool is None:
+      batch_pool = ProcessPoolExecutor(max_workers=num_workers)
+    batches = [batch for batch in np.array_split(uncached, num_workers) if len(batch) > 0]
+    results = batch_pool.map(run_temp_batch, [[params_list[i] for i in batch] for batch in batches])
+    for batch, batch_temps in zip(batches, results):
+      temps[batch] = batch_temps
+  return temps
 
 # Output function to write parameters to file in scipy callback
-def write_params_to_file(params_arr, convergence):
-  quad_grad, rf_freq, rf_amp = params_arr
+# The objective runs in worker processes, so the best temperature is taken from the intermediate result
+def write_params_to_file(intermediate_result):
+  quad_grad, rf_freq, rf_amp = intermediate_result.x
   global iteration_num
-  global current_temp
-  writer.writerow([iteration_num, quad_grad, rf_freq, rf_amp, current_temp])
+  if population_map is not None:
+    fidelity_level = population_map.fidelity_level(intermediate_result.x)
+  else:
+    fidelity_level = len(fidelity_levels) - 1
+  writer.writerow([iteration_num, quad_grad, rf_freq, rf_amp, intermediate_result.fun, fidelity_level])
   f.flush()
+  save_best(best_file_name, intermediate_result.fun)
   iteration_num += 1
 
-if debug:
-  print(calculate_z0(14.5, 30.0))
-  # print(calculate_timestep_PSD("shell_trap_output/pos.txt", "shell_trap_output/vel.txt", 1.0, 9000, 520e-6))
-
-else:
-  # Run the differential evolution function and output evolution to a file
-  kHzToGauss = 0.002857
-  bounds = [(25, 100), (14, 16), (50 * kHzToGauss, 250 * kHzToGauss)]
-  for i in range(1, 100):
-    params_file_name = 'shell_trap_output/optimize_params_differential_out_2.' + str(i) + '.csv'
-    x0 = (uniform(25, 100), uniform(14, 16), uniform(50 * kHzToGauss, 250 * kHzToGauss))
-    with open(params_file_name, 'w') as f:
-      header = ['iteration number', 'quad gradient', 'rf frequency', 'rf amplitude', 'current temperature']
-      writer = csv.writer(f)
-      writer.writerow(header)
-      res = differential_evolution(
-        get_thermalisation_temp, 
-        bounds, 
-        maxiter=60,
-        popsize=15,
-        mutation=0.7,
-        tol=1e-8,
-        callback=write_params_to_file,
-        x0=x0
+if __name__ == '__main__':
+  if debug:
+    print(calculate_z0(14.5, 30.0))
+    # print(calculate_timestep_PSD("shell_trap_output/pos.txt", "shell_trap_output/vel.txt", 1.0, 9000, 520e-6))
+
+  else:
+    # Run the chosen optimiser and output evolution to a file
+    kHzToGauss = 0.002857
+    bounds = [(25, 100), (14, 16), (50 * kHzToGauss, 250 * kHzToGauss)]
+    runner.resolve_binary()
+    header = ['iteration number', 'quad gradient', 'rf frequency', 'rf amplitude', 'current temperature', 'fidelity level']
+    res = None
+    # Each campaign is pruned against its own best temperature, not one left by an earlier campaign
+    reset_best(best_file_name)
+    if optimizer == 'differential evolution':
+      objective, evaluation_kwargs = get_thermalisation_temp, {'workers': num_workers}
+      if screening:
+        population_map = ScreenedPopulationMap(get_thermalisation_temp, fidelity_levels, screening_eta, num_workers, fidelity_log_file_name)
+        evaluation_kwargs = {'workers': population_map}
+      elif batch_evaluation:
+        objective, evaluation_kwargs = get_thermalisation_temp_batch, {'vectorized': True}
+
+      for i in range(1, 100):
+        params_file_name = 'shell_trap_output/optimize_params_differential_out_2.' + str(i) + '.csv'
+        checkpoint_file_name = 'shell_trap_output/optimize_params_differential_out_2.' + str(i) + '_checkpoint.npz'
+        x0 = (uniform(25, 100), uniform(14, 16), uniform(50 * kHzToGauss, 250 * kHzToGauss))
+
+        # Skip runs which finished before a restart
+        checkpoint = load_checkpoint(checkpoint_file_name)
+        if checkpoint is not None and checkpoint['finished']:
+          print('Skipping finished run ' + str(i))
+          continue
+
+        # The restarts are independent, so each run is only pruned against its own best temperature: a
+        # resumed run starts from the best of its checkpointed population, a new run from none
+        reset_best(best_file_name, None if checkpoint is None else np.min(checkpoint['population_energies']))
+
+        f, writer, iteration_num = open_iteration_csv(params_file_name, header, checkpoint_file_name)
+        with f:
+          res = resumable_differential_evolution(
+            objective, 
+            bounds, 
+            checkpoint_file_name,
+            checkpoint_every=checkpoint_every,
+            run_index=i,
+            maxiter=60,
+            popsize=15,
+            mutation=0.7,
+            tol=1e-8,
+            callback=write_params_to_file,
+            x0=x0,
+            updating='deferred',
+            **evaluation_kwargs
+          )
+
+      if population_map is not None:
+        population_map.close()
+      if batch_pool is not None:
+        batch_pool.shutdown()
+
+    elif optimizer == 'surrogate':
+      with open(surrogate_params_file_name, 'w') as f:
+        writer = csv.writer(f)
+        writer.writerow(header)
+        res = surrogate_minimize(
+          get_thermalisation_temp,
+          bounds,
+          maxiter=surrogate_maxiter,
+          batch_size=num_workers,
+          workers=num_workers,
+          callback=write_params_to_file
+        )
+
+    elif optimizer == 'benchmark':
+      benchmark(
+        get_thermalisation_temp,
+        bounds,
+        benchmark_temp,
+        benchmark_max_evaluations,
+        batch_size=num_workers,
+        workers=num_workers,
+        de_kwargs={'popsize': 15, 'mutation': 0.7, 'tol': 1e-8}
       )
 
-  print(res)
+    print(res)
+    hits, misses, entries = evaluation_cache.stats()
+    print('Evaluation cache: ' + str(hits) + ' hits, ' + str(misses) + ' misses, ' + str(entries) + ' entries')